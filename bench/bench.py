@@ -0,0 +1,269 @@
+#!/bin/env python
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import time
+
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+XCRYPT = os.path.join(ROOT, 'xcrypt', 'xcrypt.py')
+VERTU = os.path.join(ROOT, 'vertu', 'vertu.py')
+sys.path.insert(0, os.path.dirname(XCRYPT))
+sys.path.insert(0, os.path.dirname(VERTU))
+
+import vertu
+import xcrypt
+
+print_v = print
+CHUNK_SIZE = 1024 * 1024
+MANIFEST = 'FW/FW.ver'
+HEADER = '+|BENCH|SYNTHETIC|HKMC|BENCH|0|0'
+# random bytes to text with short lines and to binary data without newlines
+TEXT_TABLE = bytes(0x0a if i % 16 == 0 else 0x61 + i % 26 for i in range(256))
+BINARY_TABLE = bytes(0x0b if i == 0x0a else i for i in range(256))
+BLOCK = xcrypt.BLOCK_SIZE
+META = xcrypt.META_SIZE
+# sizes around the AES block, the metadata and the default buffer sizes
+ODD_SIZES = [1, BLOCK - 1, BLOCK, BLOCK + 1, 2 * BLOCK + 1, META - 1, META,
+             META + 1, 64 * 1024 - 1, 64 * 1024 + 1, 256 * 1024 + 3,
+             CHUNK_SIZE - 1, CHUNK_SIZE + 1, 4 * CHUNK_SIZE + 7]
+
+
+def write_random(filename, size, rng, table=None):
+    """Writes size random bytes into the file, translated by the table"""
+    with open(filename, 'wb') as file_out:
+        while size > 0:
+            data = rng.randbytes(min(size, CHUNK_SIZE))
+            file_out.write(data.translate(table) if table else data)
+            size -= len(data)
+
+
+def generate(root, tiny_files, odd_files, blob_size, seed=0, jobs=1):
+    """Generates a synthetic firmware tree in the root directory.
+
+    The plaintext goes to root/plain/FW, the firmware to root/firmware/FW:
+    all the files encrypted by xcrypt (except a few left as plain files, as
+    in the real firmware) together with a FW.ver manifest made by vertu."""
+    rng = random.Random(seed)
+    plain = os.path.join(root, 'plain')
+    firmware = os.path.join(root, 'firmware')
+    for directory in (plain, firmware):
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+
+    files = {}
+    for index in range(tiny_files):
+        files[f'FW/tiny/{index // 100:03}/{index:05}.bin'] = (
+            rng.randint(1, 4096), None)
+    sizes = ODD_SIZES + [rng.randrange(1, 8 * CHUNK_SIZE) | 1
+                         for index in range(odd_files)]
+    for index, size in enumerate(sizes):
+        files[f'FW/odd/{index:03}_{size}.bin'] = (size, None)
+    if blob_size:
+        # odd sizes on purpose, so the short final block is processed too
+        files['FW/blob/text.bin'] = (blob_size + 7, TEXT_TABLE)
+        files['FW/blob/binary.bin'] = (blob_size + 9, BINARY_TABLE)
+    for index in range(4):
+        files[f'FW/config/{index}.cfg'] = (rng.randint(64, 2048), TEXT_TABLE)
+
+    print_v(f'generating {len(files)} files')
+    tasks = []
+    for name, (size, table) in files.items():
+        source = os.path.join(plain, name)
+        target = os.path.join(firmware, name)
+        os.makedirs(os.path.dirname(source), exist_ok=True)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        write_random(source, size, rng, table)
+        if name.startswith('FW/config/'):
+            shutil.copyfile(source, target)     # left unencrypted
+        else:
+            tasks.append((source, target, None, None))
+
+    print_v(f'encrypting {len(tasks)} files')
+    for (source, target, iv_name, check), result in zip(
+            tasks, xcrypt.run_files(xcrypt.perform_encrypt, tasks, None,
+                                    jobs)):
+        if result:
+            raise RuntimeError(f'failed to encrypt {source} ({result})')
+
+    print_v('creating the manifest')
+    manifest = os.path.join(firmware, MANIFEST)
+    with open(manifest, 'w') as file_out:
+        file_out.write(f'{HEADER}\n')
+    if vertu.VersionManifest(manifest, jobs=jobs).update():
+        raise RuntimeError('failed to create the manifest')
+
+
+def tree_size(directory):
+    """Returns the number and the total size of the files in the directory"""
+    files = size = 0
+    for path, subdirs, names in os.walk(directory):
+        for name in names:
+            files += 1
+            size += os.path.getsize(os.path.join(path, name))
+    return files, size
+
+
+def measure(root, command, output=None, repeat=1):
+    """Runs the command in the root directory (removing its output before
+    each run), returns the best time in seconds and the exit code"""
+    best = None
+    for attempt in range(repeat):
+        if output and os.path.exists(os.path.join(root, output)):
+            shutil.rmtree(os.path.join(root, output))
+        start = time.perf_counter()
+        code = subprocess.run([sys.executable] + command, cwd=root,
+                              stdout=subprocess.DEVNULL).returncode
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, code
+
+
+def run_benchmarks(root, block_sizes, jobs=1, repeat=1):
+    """Lazy function (generator) to run the benchmarks, yields the results"""
+    firmware = tree_size(os.path.join(root, 'firmware', 'FW'))
+    plain = tree_size(os.path.join(root, 'plain', 'FW'))
+    manifest = os.path.join('firmware', MANIFEST)
+    options = ['-j', str(jobs)]
+
+    runs = [('xcrypt', 'test', None, firmware,
+             [XCRYPT, '-t', 'firmware/FW'] + options, None)]
+    for block_size in block_sizes:
+        runs += [
+            ('xcrypt', 'decrypt', block_size, firmware,
+             [XCRYPT, '-d', '--mirror', '-b', str(block_size), 'firmware/FW',
+              '-o', 'out/'] + options, 'out'),
+            ('xcrypt', 'encrypt', block_size, plain,
+             [XCRYPT, '-e', '-b', str(block_size), 'plain/FW',
+              '-o', 'out/'] + options, 'out'),
+            ('vertu', 'test', block_size, firmware,
+             [VERTU, '-t', '--no-cache', '-b', str(block_size), manifest]
+             + options, None),
+            ('vertu', 'update', block_size, firmware,
+             [VERTU, '-u', '--no-cache', '-b', str(block_size), manifest]
+             + options, None),
+        ]
+
+    for tool, operation, block_size, (files, size), command, output in runs:
+        print_v(f'{tool} {operation} (block size {block_size}) ... ', end='',
+                flush=True)
+        seconds, code = measure(root, command, output, repeat)
+        print_v(f'{seconds:.3f}s')
+        yield {
+            'tool': tool,
+            'operation': operation,
+            'block_size': block_size,
+            'jobs': jobs,
+            'files': files,
+            'bytes': size,
+            'seconds': round(seconds, 6),
+            'mb_per_s': round(size / seconds / 1e6, 3),
+            'files_per_s': round(files / seconds, 3),
+            'exit_code': code,
+        }
+
+    if os.path.exists(os.path.join(root, 'out')):
+        shutil.rmtree(os.path.join(root, 'out'))
+
+
+def main():
+    global print_v
+
+    parser = argparse.ArgumentParser(
+        description='benchmarks xcrypt and vertu on a synthetic firmware tree')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='enable verbose output')
+    parser.add_argument('-d', '--directory', type=str, dest='directory',
+                        default='bench-tree',
+                        help='where the synthetic tree is generated (reused '
+                             'if it has the same parameters)')
+    parser.add_argument('--tiny', type=int, dest='tiny', default=2000,
+                        help='number of tiny files (default 2000)')
+    parser.add_argument('--odd', type=int, dest='odd', default=50,
+                        help='number of random odd sized files on top of the '
+                             'fixed ones (default 50)')
+    parser.add_argument('--blob-size', type=int, dest='blob_size',
+                        default=1024, metavar='MB',
+                        help='size of the newline dense and the newline free '
+                             'blobs in MB (default 1024, 0 means none)')
+    parser.add_argument('--seed', type=int, dest='seed', default=0,
+                        help='seed of the generated data (default 0)')
+    parser.add_argument('-b', '--block-sizes', type=str, dest='block_sizes',
+                        default='65536,1048576,4194304',
+                        help='comma separated block sizes to benchmark '
+                             '(default 65536,1048576,4194304)')
+    parser.add_argument('-j', '--jobs', type=int, dest='jobs', default=1,
+                        help='passed to the tools as -j (default 1)')
+    parser.add_argument('-r', '--repeat', type=int, dest='repeat', default=1,
+                        help='runs of each benchmark, the best one counts '
+                             '(default 1)')
+    parser.add_argument('-o', '--output', type=str, dest='output',
+                        help='write the JSON results into the file instead '
+                             'of the standard output')
+    args = parser.parse_args()
+
+    # the results may go to the standard output, so messages go to stderr
+    print_v = (lambda *a, **k: print(*a, file=sys.stderr, **k)) \
+        if args.verbose else lambda *a, **k: None
+    xcrypt.print_v = vertu.print_v = lambda *a, **k: None
+
+    block_sizes = [int(size) for size in args.block_sizes.split(',')]
+    if any(size <= 0 or size % xcrypt.BLOCK_SIZE for size in block_sizes):
+        print('ERROR: the block sizes should be dividable by 16!')
+        sys.exit(1)
+
+    tree = {
+        'tiny': args.tiny,
+        'odd': args.odd,
+        'blob_size': args.blob_size * 1024 * 1024,
+        'seed': args.seed,
+    }
+    root = os.path.abspath(args.directory)
+    parameters = os.path.join(root, 'tree.json')
+    try:
+        with open(parameters) as file_in:
+            existing = json.load(file_in)
+    except (OSError, ValueError):
+        existing = None
+    if existing != tree:
+        print_v(f'Generating the synthetic firmware tree in "{root}"')
+        os.makedirs(root, exist_ok=True)
+        generate(root, tree['tiny'], tree['odd'], tree['blob_size'],
+                 tree['seed'], args.jobs)
+        with open(parameters, 'w') as file_out:
+            json.dump(tree, file_out)
+    else:
+        print_v(f'Using the synthetic firmware tree in "{root}"')
+
+    report = {
+        'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'tree': tree,
+        'results': list(run_benchmarks(root, block_sizes, args.jobs,
+                                       args.repeat)),
+    }
+    if args.output:
+        with open(args.output, 'w') as file_out:
+            json.dump(report, file_out, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    # the tree mixes encrypted and plain files, so the test always "fails"
+    if any(result['exit_code'] for result in report['results']
+           if (result['tool'], result['operation']) != ('xcrypt', 'test')):
+        print('ERROR: at least one of the benchmarked runs has failed!',
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
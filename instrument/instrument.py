@@ -0,0 +1,290 @@
+#!/bin/env python
+"""Progress throttling, per-file/per-stage timings and the journals of the
+resumable runs, shared by the tools.
+
+A Report collects a FileRecord for every processed file.  While a file is
+being processed its record is the current one of the thread, so the code
+deep down can time its stages with current().stage(name) without passing
+the record around; without a report that is a no-op.  The stages are timed
+exclusively (a nested stage pauses the outer one), so they add up to the
+time of the file and the rest is reported as 'other'.
+"""
+import json
+import threading
+import time
+
+from collections import defaultdict
+
+PROGRESS_INTERVAL = 0.2     # seconds between two progress updates
+
+_local = threading.local()
+
+
+class Throttle:
+    """ Tells whether a rate limited action (e.g. printing the progress) is
+    due, at most once per interval seconds """
+
+    def __init__(self, interval=PROGRESS_INTERVAL):
+        self.interval = interval
+        self.last = None
+
+    def __call__(self):
+        now = time.monotonic()
+        if self.last is not None and now - self.last < self.interval:
+            return False
+        self.last = now
+        return True
+
+
+class Stage:
+    """ A reusable context manager timing a stage of a file """
+
+    __slots__ = ('record', 'name')
+
+    def __init__(self, record, name):
+        self.record = record
+        self.name = name
+
+    def __enter__(self):
+        self.record.enter(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        self.record.leave()
+
+
+class NullStage:
+    """ The stage of no file, does nothing """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class FileRecord:
+    """ Timings of a single file """
+
+    def __init__(self, name, size=0):
+        self.name = name
+        self.size = size
+        self.result = None
+        self.seconds = 0.0
+        self.stages = defaultdict(float)
+        self.timers = {}
+        self.stack = []
+        self.mark = 0.0
+
+    def stage(self, name):
+        """ Returns the context manager timing the stage """
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = Stage(self, name)
+        return timer
+
+    def enter(self, name):
+        now = time.perf_counter()
+        if self.stack:
+            self.stages[self.stack[-1]] += now - self.mark
+        self.stack.append(name)
+        self.mark = now
+
+    def leave(self):
+        now = time.perf_counter()
+        self.stages[self.stack.pop()] += now - self.mark
+        self.mark = now
+
+    def as_dict(self):
+        stages = dict(self.stages)
+        stages['other'] = max(self.seconds - sum(self.stages.values()), 0.0)
+        return {
+            'file': self.name,
+            'size': self.size,
+            'result': self.result,
+            'seconds': round(self.seconds, 6),
+            'stages': {name: round(seconds, 6)
+                       for name, seconds in stages.items()},
+        }
+
+
+class NullRecord:
+    """ The record used when there is no report, ignores everything """
+
+    name = None
+    size = 0
+    result = None
+    NULL_STAGE = NullStage()
+
+    def stage(self, name):
+        return self.NULL_STAGE
+
+
+NULL_RECORD = NullRecord()
+
+
+def current():
+    """ Returns the record of the file processed by this thread """
+    return getattr(_local, 'record', NULL_RECORD)
+
+
+def timed(iterable, stage):
+    """ Lazy function (generator) passing the items of the iterable through,
+    the time spent waiting for them is recorded as the stage of the current
+    file (e.g. the reads behind a chunk iterator) """
+    record = current()
+    if record is NULL_RECORD:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    timer = record.stage(stage)
+    while True:
+        with timer:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+class FileContext:
+    """ Makes a new record the current one of the thread for a file """
+
+    def __init__(self, report, name, size):
+        self.report = report
+        self.record = FileRecord(name, size)
+
+    def __enter__(self):
+        self.previous = getattr(_local, 'record', None)
+        _local.record = self.record
+        self.started = time.perf_counter()
+        return self.record
+
+    def __exit__(self, *exc):
+        self.record.seconds = time.perf_counter() - self.started
+        _local.record = self.previous
+        self.report.add(self.record)
+
+
+class Report:
+    """ Collects the records of the processed files, optionally writing them
+    into a JSON lines file as they come (followed by the summary) """
+
+    def __init__(self, filename=None):
+        self.records = []
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.file_out = open(filename, 'w') if filename else None
+
+    def file(self, name, size=0):
+        """ Returns a context manager recording the processing of a file """
+        return FileContext(self, name, size)
+
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+            if self.file_out:
+                self.file_out.write(json.dumps(record.as_dict()) + '\n')
+
+    def summary(self):
+        """ Returns the aggregated timings of the run """
+        seconds = time.perf_counter() - self.started
+        size = sum(record.size for record in self.records)
+        stages = defaultdict(float)
+        for record in self.records:
+            for name, value in record.as_dict()['stages'].items():
+                stages[name] += value
+        return {
+            'files': len(self.records),
+            'size': size,
+            'seconds': round(seconds, 6),
+            'mb_per_s': round(size / max(seconds, 1e-9) / 1e6, 3),
+            'files_per_s': round(len(self.records) / max(seconds, 1e-9), 3),
+            'stages': {name: round(value, 6)
+                       for name, value in sorted(stages.items())},
+        }
+
+    def table(self, slowest=10):
+        """ Returns the summary as a printable table followed by the slowest
+        files """
+        summary = self.summary()
+        busy = sum(summary['stages'].values()) or 1e-9
+        lines = [
+            f"{summary['files']} files, {summary['size'] / 1e6:.1f} MB in "
+            f"{summary['seconds']:.3f}s ({summary['mb_per_s']:.1f} MB/s, "
+            f"{summary['files_per_s']:.1f} files/s)",
+            f"{'stage':<12} {'seconds':>10} {'share':>7}",
+        ]
+        for name, value in sorted(summary['stages'].items(),
+                                  key=lambda item: item[1], reverse=True):
+            lines.append(f'{name:<12} {value:>10.3f} {value / busy:>7.1%}')
+        records = sorted(self.records, key=lambda record: record.seconds,
+                         reverse=True)[:slowest]
+        if records:
+            lines.append('slowest files:')
+        for record in records:
+            stages = record.as_dict()['stages']
+            stage = max(stages, key=stages.get)
+            lines.append(f'{record.seconds:>10.3f}s  {stage:<8} '
+                         f'{record.name}')
+        return '\n'.join(lines)
+
+    def close(self):
+        """ Writes the summary at the end of the JSON lines file """
+        if self.file_out:
+            self.file_out.write(json.dumps({'summary': self.summary()}) + '\n')
+            self.file_out.close()
+            self.file_out = None
+
+
+class JournalFile:
+    """ An append-only file of JSON lines (one object per line) recording the
+    progress of a run, so an interrupted run can be resumed from it
+
+    When resuming, the objects having all the keys are loaded into entries,
+    the others are counted as damaged, and a torn last line of an interrupted
+    run is ignored (and not appended to).  Otherwise the file is started
+    afresh.  The lines are flushed as they are appended, from any thread. """
+
+    def __init__(self, filename, resume=False, keys=()):
+        self.filename = filename
+        self.keys = keys
+        self.entries = []
+        self.damaged = 0
+        self.lock = threading.Lock()
+        torn = self.load() if resume else False
+        self.file_out = open(filename, 'a' if resume else 'w')
+        if torn:
+            self.file_out.write('\n')
+
+    def load(self):
+        """ Loads the entries, returns True if the last line is torn """
+        line = '\n'
+        try:
+            with open(self.filename) as file_in:
+                for line in file_in:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        entry = None
+                    if isinstance(entry, dict) and all(
+                            key in entry for key in self.keys):
+                        self.entries.append(entry)
+                    elif line.endswith('\n'):
+                        self.damaged += 1
+        except FileNotFoundError:
+            pass
+        return not line.endswith('\n')
+
+    def append(self, entry):
+        line = json.dumps(entry)
+        with self.lock:
+            self.file_out.write(f'{line}\n')
+            self.file_out.flush()
+
+    def flush(self):
+        with self.lock:
+            self.file_out.flush()
+
+    def close(self):
+        self.file_out.close()
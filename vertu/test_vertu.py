@@ -0,0 +1,87 @@
+#!/bin/env python
+import os
+import random
+import tempfile
+import unittest
+import zlib
+
+from unittest import mock
+
+import vertu
+
+
+class Crc32CombineTest(unittest.TestCase):
+    """ crc32_combine() against zlib.crc32 of the whole data """
+
+    def setUp(self):
+        self.data = random.Random(0).randbytes(10007)
+
+    def test_split_points(self):
+        for split in (1, 15, 16, 17, 4096, 10006):
+            first, second = self.data[:split], self.data[split:]
+            self.assertEqual(
+                vertu.crc32_combine(zlib.crc32(first), zlib.crc32(second),
+                                    len(second)),
+                zlib.crc32(self.data))
+
+    def test_empty_second_part(self):
+        crc32 = zlib.crc32(self.data)
+        self.assertEqual(vertu.crc32_combine(crc32, 0, 0), crc32)
+
+    def test_empty_first_part(self):
+        crc32 = zlib.crc32(self.data)
+        self.assertEqual(vertu.crc32_combine(0, crc32, len(self.data)),
+                         crc32)
+
+    def test_both_empty(self):
+        self.assertEqual(vertu.crc32_combine(0, 0, 0), 0)
+
+
+class Crc32FileTest(unittest.TestCase):
+    """ The split and memory mapped CRC32 paths against the serial one """
+
+    SIZES = (0, 1, 15, 16, 17, 4095, 4096, 4097, 65536, 100003)
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        rng = random.Random(1)
+        self.files = {}
+        for size in self.SIZES:
+            path = os.path.join(self.directory.name, f'{size}.bin')
+            data = rng.randbytes(size)
+            with open(path, 'wb') as file_out:
+                file_out.write(data)
+            self.files[path] = zlib.crc32(data)
+
+    def check(self, **options):
+        for path, crc32 in self.files.items():
+            with self.subTest(path=os.path.basename(path), **options):
+                self.assertEqual(vertu.crc32_file(path, **options), crc32)
+
+    def test_serial(self):
+        for chunk_size in (1, 16, 4096, vertu.CHUNK_SIZE):
+            self.check(chunk_size=chunk_size)
+        self.check(use_mmap=True)
+
+    def test_split(self):
+        # every file is large enough to be split, the segment counts do not
+        # divide most of the sizes and can exceed the tiny ones
+        with mock.patch.object(vertu, 'SPLIT_MIN_SIZE', 1):
+            for split in (2, 3, 7, 16, 33):
+                for use_mmap in (False, True):
+                    self.check(chunk_size=4096, use_mmap=use_mmap,
+                               split=split)
+
+    def test_split_matches_serial(self):
+        with mock.patch.object(vertu, 'SPLIT_MIN_SIZE', 1):
+            for path in self.files:
+                serial = vertu.crc32_file(path, chunk_size=1000)
+                for split in (2, 5, 9):
+                    self.assertEqual(
+                        vertu.crc32_file(path, chunk_size=1000, split=split),
+                        serial)
+
+
+if __name__ == '__main__':
+    unittest.main()
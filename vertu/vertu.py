@@ -1,12 +1,26 @@
 #!/usr/bin/env python 
 import argparse
+import csv
+import json
+import mmap
 import os
+import struct
 import sys
 import zlib
 
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from enum import Flag
+from operator import attrgetter
 
-print_v = print
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                os.pardir, 'instrument'))
+from instrument import JournalFile, Report, current
+
+print_v = lambda *a, **k: None    # verbose messages, enabled by main()
+CHUNK_SIZE=1024*1024    # default read size for CRC calculations
+SPLIT_MIN_SIZE=64*1024*1024 # smaller files are not worth splitting
+CRC32_POLY=0xedb88320   # reflected CRC32 polynomial used by zlib
 
 def hardware_int_view(value, bits, signed):
     base = 1 << bits
@@ -14,6 +28,257 @@ def hardware_int_view(value, bits, signed):
     return value - base if signed and value.bit_length() == bits else value
 
 
+def crc32_multmodp(a, b):
+    """Multiplies a(x) by b(x) modulo the CRC32 polynomial (zlib's multmodp)"""
+    m = 1 << 31
+    p = 0
+    while True:
+        if a & m:
+            p ^= b
+            if (a & (m - 1)) == 0:
+                break
+        m >>= 1
+        b = (b >> 1) ^ CRC32_POLY if b & 1 else b >> 1
+    return p
+
+
+def crc32_x2nmodp(n, k):
+    """Returns x^(n * 2^k) modulo the CRC32 polynomial (zlib's x2nmodp)"""
+    p = 1 << 31     # x^0 == 1
+    while n:
+        if n & 1:
+            p = crc32_multmodp(CRC32_X2N_TABLE[k & 31], p)
+        n >>= 1
+        k += 1
+    return p
+
+
+def crc32_x2n_table():
+    """Builds the table of x^2^n modulo the CRC32 polynomial"""
+    table = []
+    p = 1 << 30     # x^1
+    for n in range(32):
+        table.append(p)
+        p = crc32_multmodp(p, p)
+    return table
+
+CRC32_X2N_TABLE = crc32_x2n_table()
+
+
+def crc32_combine(crc1, crc2, len2):
+    """Combines the CRC32 of two consecutive blocks of data into the CRC32 of
+    the whole (zlib's crc32_combine), len2 is the length of the second one"""
+    return crc32_multmodp(crc32_x2nmodp(len2, 3), crc1) ^ crc2
+
+
+def crc32_range(fd, start, end, chunk_size=CHUNK_SIZE):
+    """Calculates the CRC32 of the [start, end) range of an open file"""
+    result = 0
+    buffer = bytearray(max(1, min(chunk_size, end - start)))
+    view = memoryview(buffer)
+    while start < end:
+        length = os.preadv(fd, [view[:min(len(buffer), end - start)]], start)
+        if not length:
+            break
+        result = zlib.crc32(view[:length], result)
+        start += length
+    return result
+
+
+def crc32_split(file_in, size, chunk_size=CHUNK_SIZE, split=2,
+                mapping=None):
+    """Calculates the CRC32 of a large file as segments hashed in parallel.
+
+    Every segment is hashed on its own thread (zlib releases the GIL) either
+    from the mapping or with positional reads, and the segment CRCs are then
+    merged in order with crc32_combine()."""
+    step = -(-size // split)
+    ranges = [(start, min(start + step, size))
+              for start in range(0, size, step)]
+    with ThreadPoolExecutor(max_workers=split) as pool:
+        if mapping is not None:
+            with memoryview(mapping) as view:
+                results = list(pool.map(
+                    lambda r: zlib.crc32(view[r[0]:r[1]]), ranges))
+        else:
+            results = list(pool.map(
+                lambda r: crc32_range(file_in.fileno(), r[0], r[1],
+                                      chunk_size), ranges))
+
+    result = 0
+    for (start, end), crc32 in zip(ranges, results):
+        result = crc32_combine(result, crc32, end - start)
+    return result
+
+
+def crc32_file(path, chunk_size=CHUNK_SIZE, use_mmap=False, split=1):
+    """Calculates the CRC32 of a file.
+
+    The file is read in fixed chunks straight into a single reusable buffer
+    (no line splitting, no per-chunk allocations) or, with use_mmap, the CRC
+    is calculated over a memory mapping of the whole file.  A file of at
+    least SPLIT_MIN_SIZE bytes is hashed as split segments in parallel."""
+    result = 0
+    with open(path, 'rb', buffering=0) as file_in:
+        size = os.fstat(file_in.fileno()).st_size
+        if split > 1 and size and size >= SPLIT_MIN_SIZE:
+            if use_mmap:
+                with mmap.mmap(file_in.fileno(), 0,
+                               access=mmap.ACCESS_READ) as mapping:
+                    return crc32_split(file_in, size, chunk_size, split,
+                                       mapping)
+            if hasattr(os, 'preadv'):
+                return crc32_split(file_in, size, chunk_size, split)
+        if use_mmap and size:
+            with mmap.mmap(file_in.fileno(), 0,
+                           access=mmap.ACCESS_READ) as mapping:
+                return zlib.crc32(mapping)
+
+        buffer = bytearray(max(1, min(chunk_size, size)))
+        view = memoryview(buffer)
+        reading, crc = current().stage('read'), current().stage('crc')
+        while True:
+            with reading:
+                length = file_in.readinto(buffer)
+            if not length:
+                break
+            with crc:
+                result = zlib.crc32(view[:length], result)
+    return result
+
+
+class CrcCache:
+    """ A sidecar file with known CRC32 values of the firmware files
+
+    The entries are keyed by the file path and are only trusted while the
+    inode, size and modification time (in ns) of the file stay the same.
+    The file is a compact binary list of records, it is loaded completely
+    and written back by save() with only the entries used in this run, so
+    stale entries (removed or renamed files) are evicted.
+    """
+
+    MAGIC = b'VERCRC1\n'
+    RECORD = struct.Struct('<QQqIH')   # inode, size, mtime_ns, crc32, path len
+
+    def __init__(self, filename, rehash=False):
+        self.filename = filename
+        self.rehash = rehash            # ignore the stored values
+        self.entries = {}
+        self.used = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, 'rb') as file_in:
+                data = file_in.read()
+        except FileNotFoundError:
+            return
+        if not data.startswith(self.MAGIC):
+            print_v(f'Ignoring the unknown CRC cache "{self.filename}"')
+            return
+
+        offset = len(self.MAGIC)
+        try:
+            while offset < len(data):
+                (inode, size, mtime_ns, crc32,
+                 length) = self.RECORD.unpack_from(data, offset)
+                offset += self.RECORD.size
+                path = data[offset:offset+length].decode('utf-8')
+                offset += length
+                self.entries[path] = (inode, size, mtime_ns, crc32)
+        except (struct.error, UnicodeDecodeError):
+            print_v(f'Ignoring the damaged tail of "{self.filename}"')
+
+    def lookup(self, path, stat):
+        """ Returns the stored CRC32 if the file has not changed, or None """
+        entry = self.entries.get(path)
+        if (self.rehash or entry is None
+                or entry[:3] != (stat.st_ino, stat.st_size,
+                                 stat.st_mtime_ns)):
+            return None
+        self.used[path] = entry
+        return entry[3]
+
+    def store(self, path, stat, crc32):
+        self.used[path] = (stat.st_ino, stat.st_size, stat.st_mtime_ns,
+                           crc32)
+
+    def save(self):
+        """ Writes the entries used in this run back to the sidecar file """
+        records = [self.MAGIC]
+        for path, entry in self.used.items():
+            name = path.encode('utf-8')
+            records.append(self.RECORD.pack(*entry, len(name)))
+            records.append(name)
+        with open(f'{self.filename}.tmp', 'wb') as file_out:
+            file_out.write(b''.join(records))
+        os.replace(f'{self.filename}.tmp', self.filename)
+        self.entries = dict(self.used)
+
+
+class CrcJournal(CrcCache):
+    """ An append-only journal of the CRC32 values calculated in a run
+
+    Every value is appended as a JSON line as soon as it is known, so an
+    interrupted validation or update can be resumed without hashing the
+    files done already (the values are trusted the same way as those of
+    the CrcCache).  Without resuming, the journal is started afresh.
+    """
+
+    KEYS = ('path', 'inode', 'size', 'mtime_ns', 'crc32')
+
+    def __init__(self, filename, resume=False):
+        self.journal = JournalFile(filename, resume, self.KEYS)
+        if self.journal.damaged:
+            print_v(f'Ignoring {self.journal.damaged} damaged line(s) of '
+                    f'"{filename}"')
+        super().__init__(filename, not resume)
+
+    def load(self):
+        for entry in self.journal.entries:
+            self.entries[entry['path']] = (entry['inode'], entry['size'],
+                                           entry['mtime_ns'], entry['crc32'])
+
+    def store(self, path, stat, crc32):
+        super().store(path, stat, crc32)
+        self.journal.append({'path': path, 'inode': stat.st_ino,
+                             'size': stat.st_size,
+                             'mtime_ns': stat.st_mtime_ns, 'crc32': crc32})
+
+    def save(self):
+        """ Everything has been written already, the journal stays open as
+        the manifest may validate the files again (see close()) """
+        self.journal.flush()
+
+    def close(self):
+        self.journal.close()
+
+
+def result2reason(code):
+    """ Provides a human readable reason of a VersionFile.validate() code """
+    msg =''
+
+    # let's avoid using match/case it is too new
+    if code == 0:
+        return 'OK'
+
+    if code == 0x4:
+        return 'File not found'
+
+    if code & 0x1:
+        msg = 'Size mismatch'
+
+    if code & 0x2:
+        if msg:
+            msg += ' + '
+        msg += 'CRC32 check failed'
+
+    if code & 0x4:
+        msg += ' (and file disapeared)'
+
+    return msg
+
+
 class VersionHeader:
     """ The header line of the version file """
 
@@ -49,49 +314,75 @@ class VersionHeader:
 class VersionFile:
     """ Manages a single file object in the file list """
 
-    prefix = ''
+    # manifests can have hundreds of thousands of entries, so no __dict__
+    __slots__ = ('path', 'name', 'version', 'crc32', 'size', 'unknown',
+                 'sort_key')
 
     def __init__(self, definition):
         self.parse(definition)
 
     def parse(self, definition):
-        (self.path, self.name, self.version,
-         self.crc32, self.size, self.unknown) = definition.split('|')
+        """ definition is either the manifest line or its split fields """
+        if isinstance(definition, str):
+            definition = definition.split('|')
+        (path, name, version, crc32, size, unknown) = definition
 
-        # normalise path
-        self.path = self.path.replace('\\', '/')
+        # normalise path (interned, as many entries share the same directory)
+        self.path = path = sys.intern(path.replace('\\', '/'))
+        self.name = name
 
         # convert to integers
-        self.version = int(self.version)
-        self.unknown = int(self.unknown)
+        self.version = int(version)
+        self.unknown = int(unknown)
 
-        # zlib.crc32() is always unsigned integer in Python
-        self.crc32 = hardware_int_view(int(self.crc32), 32, False)
+        # zlib.crc32() is always unsigned integer in Python (the masks are
+        # the unsigned hardware_int_view(), but cheaper for large manifests)
+        self.crc32 = int(crc32) & 0xFFFFFFFF
 
         # it seems the manifest defines it as 64bit right away, but it costs us
         # nothing to ensure we get the right integer into the variable
-        self.size = hardware_int_view(int(self.size), 64, False)
-
-    def crc(self, update=False):
-        result = 0
-        for file in open(
-                os.path.join(self.prefix, self.path, self.name),"rb"):
-            result = zlib.crc32(file, result)
+        self.size = int(size) & 0xFFFFFFFFFFFFFFFF
+
+        # HKM sorts the manifest by the path and then by the name ignoring
+        # the case, so the key is calculated once instead of on every compare
+        # (a single string sorts like the (path, name) pair since \0 is lower
+        # than any character of a path), it also serves as the index key
+        self.sort_key = f'{path}\0{name}'.lower()
+
+    def crc(self, prefix, update=False, chunk_size=CHUNK_SIZE, use_mmap=False,
+            split=1, cache=None):
+        """ prefix is the firmware directory the path is relative to, the
+        value is taken from the CrcCache if the file has not changed """
+        path = os.path.join(prefix, self.path, self.name)
+        result = None
+        if cache is not None:
+            key = f'{self.path}/{self.name}'
+            stat = os.stat(path)
+            result = cache.lookup(key, stat)
+        if result is None:
+            # the mmap and split paths cannot tell reading from hashing
+            with current().stage('crc'):
+                result = crc32_file(path, chunk_size, use_mmap, split)
+            if cache is not None:
+                cache.store(key, stat, result)
         if update:
             self.crc32 = result
         return result
 
-    def validate(self, update=False):
+    def validate(self, prefix, update=False, chunk_size=CHUNK_SIZE,
+                 use_mmap=False, split=1, cache=None):
+        """ prefix is the firmware directory the path is relative to """
         result = 0
         try:
             size = os.path.getsize(
-                os.path.join(self.prefix, self.path, self.name))
+                os.path.join(prefix, self.path, self.name))
             if self.size != size:
                 if update:
                     self.size = size
                 else:
                     result |= 0x1
-            crc32 = self.crc(update)
+            crc32 = self.crc(prefix, update, chunk_size, use_mmap, split,
+                             cache)
             if self.crc32 != crc32:
                 result |= 0x2
         except FileNotFoundError:
@@ -115,38 +406,56 @@ class VersionFile:
 
     def __lt__(self, other):
         """ sorting operator that matches HKM's logic in the manifest """
-        if self.path == other.path:
-            return self.name.lower() < other.name.lower()
-        return self.path.lower() < other.path.lower()
+        return self.sort_key < other.sort_key
 
 class VersionManifest:
     """ Handles operations related to the version files included in HKM firmware """
 
-    def __init__(self, filename):
+    def __init__(self, filename, chunk_size=CHUNK_SIZE, use_mmap=False,
+                 jobs=1, split=1, cache=None, report=None):
         self.filelist = []
+        self.chunk_size = chunk_size    # CRC calculation settings
+        self.use_mmap = use_mmap
+        self.jobs = jobs                # number of files checked in parallel
+        self.split = split              # number of segments of a large file
+        self.cache = cache              # an optional CrcCache
+        self.report = report            # an optional Report of the timings
         self.manifest = os.path.abspath(filename)
         self.manifest_dir = os.path.basename(os.path.dirname(self.manifest))
         self.firmware_dir = os.path.dirname(os.path.dirname(self.manifest))
 
-        # XXX: out assumption here that we are never going to work with two
-        #      firmware directories at the same time, if this changes the
-        #      following line needs to be reworked!
-        VersionFile.prefix = self.firmware_dir
-
         self.read(self.manifest)
 
     def read(self, filename):
-        count = 0
-        for line in open(filename, 'r'): # we are working with a text file
-            count += 1
-            if count == 1:  # the first line is a header
-                if line[0] != '+':
-                    raise(SyntaxError)
-                self.header = VersionHeader(line.rstrip())
-                continue
+        with open(filename, 'r') as file_in: # we are working with a text file
+            lines = file_in.read().splitlines()
+
+        # the first line is a header
+        if not lines or not lines[0] or lines[0][0] != '+':
+            raise(SyntaxError)
+        self.header = VersionHeader(lines[0].rstrip())
+
+        # split all the entries at once rather than line by line
+        fields = '|'.join(line.rstrip() for line in lines[1:]
+                          if line.strip()).split('|')
+        if len(fields) % 6:
+            if fields != ['']:  # there are no entries at all
+                raise(SyntaxError)
+            fields = []
+        entries = iter(fields)
+        self.filelist.extend(map(VersionFile, zip(*[entries] * 6)))
+        self.reindex()
+
 
-            # ready to enroll a new entry now
-            self.filelist.append(VersionFile(line.rstrip()))
+    def reindex(self):
+        """ Rebuilds the index of the entries by their lower case path """
+        self.index = {file.sort_key: file for file in self.filelist}
+
+
+    def find(self, path, name):
+        """ Returns the entry of the file (case insensitive) or None """
+        path = path.replace('\\', '/')
+        return self.index.get(f'{path}\0{name}'.lower())
 
 
     def backup(self, suffix='.orig'):
@@ -162,38 +471,43 @@ class VersionManifest:
         print_v(f'Creating the new manifest file "{os.path.basename(filename)}"... ', end='')
         with open(filename, 'x') as file_out:
             file_out.write(f'{self.header}\n')  # write the header line
-            for file in sorted(self.filelist):
+            for file in sorted(self.filelist, key=attrgetter('sort_key')):
                 if file.size >= 0:              # check for removed files
                     file_out.write(f'{file}\n')
         print_v('done')
 
 
-    def validate(self, interactive=False, update=False):
-
-        def result2reason(code):
-            """ an internal function to provide human readable reasons """
-            msg =''
-
-            # let's avoid using match/case it is too new
-            if code == 0:
-                return 'OK'
+    def validate_files(self, update=False, files=None):
+        """ Lazy function (generator) to validate the files (all the files in
+        the list by default)
 
-            if code == 0x4:
-                return 'File not found'
+        With more than one job the size checks and CRC calculations run on a
+        thread pool (zlib releases the GIL while hashing), but the results
+        are always yielded in the order of the file list. """
+        if files is None:
+            files = self.filelist
 
-            if code & 0x1:
-                msg = 'Size mismatch'
+        def validate(file):
+            if self.report is None:
+                return file.validate(self.firmware_dir, update,
+                                     self.chunk_size, self.use_mmap,
+                                     self.split, self.cache)
+            with self.report.file(f'{file.path}/{file.name}',
+                                  file.size) as record:
+                record.result = file.validate(self.firmware_dir, update,
+                                              self.chunk_size, self.use_mmap,
+                                              self.split, self.cache)
+            return record.result
 
-            if code & 0x2:
-                if msg:
-                    msg += ' + '
-                msg += 'CRC32 check failed'
+        if self.jobs <= 1:
+            yield from map(validate, files)
+            return
 
-            if code & 0x4:
-                msg += ' (and file disapeared)'
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            yield from pool.map(validate, files)
 
-            return msg
 
+    def validate(self, interactive=False, update=False):
         if update:
             print_v('Re-validating and updating', end='')
         else:
@@ -201,16 +515,18 @@ class VersionManifest:
         print_v(' the firmware directory against the manifest file:')
 
         result = 0
-        for file in self.filelist:
+        for file, ret in zip(self.filelist, self.validate_files(update)):
             answer =''
             print_v(f'{os.path.join(file.path, file.name)} => ', end='')
-            ret = file.validate(update)
             if ret:
                 print_v(f'FAILED: {result2reason(ret)}')
             else:
                 print_v('ok')
             result |= ret
 
+        if self.cache:
+            self.cache.save()
+
         if result:
             print_v('ERROR: at least one file has not be processed '
                     'successfully, chances are something is broken!')
@@ -246,31 +562,109 @@ class VersionManifest:
         return result
 
 
-    def update(self, interactive=False):
+    def scan(self, root=None):
+        """ Lazy function (generator) to walk the firmware files with
+        os.scandir, yields (path, name, DirEntry) with the path relative to
+        the firmware directory (always using / as the separator), root can
+        point to another directory with the same layout """
+        root = root or self.firmware_dir
+        pending = [self.manifest_dir]
+        while pending:
+            path = pending.pop()
+            with os.scandir(os.path.join(root, path)) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        if not entry.is_symlink():  # just like os.walk()
+                            pending.append(f'{path}/{entry.name}')
+                    elif not entry.name.startswith(
+                            os.path.basename(self.manifest)):
+                        # skip the manifest itself and similar files
+                        yield path, entry.name, entry
+
+
+    def collect_changes(self):
+        """ Updates the file list from the firmware directory incrementally
+
+        Existing entries (with their version and unknown values) are kept,
+        entries of removed files are dropped and new files are added with
+        placeholder values.  Returns the lists of added, possibly changed
+        and removed entries, the first two still need to be hashed.
+
+        With a CrcCache a file has changed unless its cached value (same
+        inode, size and modification time) matches the entry, which keeps
+        the cached values of the unchanged files too.  Otherwise it has
+        changed if its size differs or it was modified after the manifest. """
+        manifest_mtime = os.stat(self.manifest).st_mtime_ns
+        cache = self.cache if self.cache and not self.cache.rehash else None
+        matched = set()
+        added = []
+        changed = []
+        for path, name, entry in self.scan():
+            # matched the same way as everywhere else, i.e. whatever the case
+            # and the path separators, an entry can only be matched once
+            file = self.find(path, name)
+            if file is None or id(file) in matched:
+                added.append(VersionFile(f'{path}|{name}|14|0|0|1'))
+                continue
+            matched.add(id(file))
+            stat = entry.stat()
+            if file.size != stat.st_size:
+                changed.append(file)
+            elif cache is not None:
+                if cache.lookup(f'{file.path}/{file.name}',
+                                stat) != file.crc32:
+                    changed.append(file)
+            elif stat.st_mtime_ns > manifest_mtime:
+                changed.append(file)
+
+        removed = [file for file in self.filelist if id(file) not in matched]
+        self.filelist = [file for file in self.filelist
+                         if id(file) in matched] + added
+        self.reindex()
+        return added, changed, removed
+
+
+    def update(self, interactive=False, incremental=False):
         result = 0
         answer = ''
 
         print_v('Collecting the manifest data from the firmware directory:')
-        self.filelist.clear()   # nuke the entries
-        for path, subdirs, files in os.walk(
-                os.path.join(self.firmware_dir, self.manifest_dir)):
-            for file in files:
-                if file.startswith(os.path.basename(self.manifest)):
-                    continue    # skip the manifest itself and similar files
-                self.filelist.append(
-                    VersionFile(
-                        f'{path[len(self.firmware_dir)+1:]}|{file}|14|0|0|1'
-                    ))
-
-        for file in self.filelist:
+        if incremental:
+            added, changed, removed = self.collect_changes()
+            files = added + changed
+            known = {id(file): (file.size, file.crc32) for file in changed}
+        else:
+            self.filelist.clear()   # nuke the entries
+            for path, name, entry in self.scan():
+                self.filelist.append(VersionFile(f'{path}|{name}|14|0|0|1'))
+            self.reindex()
+            files = self.filelist
+
+        for file, ret in zip(files, self.validate_files(True, files)):
             print_v(f'{os.path.join(file.path, file.name)} => ', end='')
-            ret = file.validate(True)
             if ret:
                 print_v('FAILED')   # should not really happen
             else:
                 print_v('ok')
             result |= ret
 
+        if self.cache:
+            self.cache.save()
+
+        if incremental:
+            # the files touched without a change in the data are not reported
+            changed = [file for file in changed
+                       if known[id(file)] != (file.size, file.crc32)]
+            # the delta is shown before asking whether to write it
+            show = print if interactive else print_v
+            for mark, entries in (('+', added), ('~', changed),
+                                  ('-', removed)):
+                for file in entries:
+                    show(f'{mark} {os.path.join(file.path, file.name)}')
+            print(f'Manifest changes: {len(added)} added, '
+                  f'{len(changed)} changed, {len(removed)} removed, '
+                  f'{len(files)} of {len(self.filelist)} files rehashed')
+
         if result:
             print_v('ERROR: at least one file has not be processed '
                     'successfully, chances are something is broken!')
@@ -297,11 +691,138 @@ class VersionManifest:
         return result
 
 
+    def diff(self, other):
+        """ Compares this manifest with another (older) one
+
+        The entries are matched through the index of the other manifest (by
+        lower case path), so the comparison is linear.
+        Returns a list of (change, old, new) tuples in the order of this
+        manifest followed by the removed entries, where the change is either
+        'added', 'removed' or a '+' joined list of what has changed ('crc32',
+        'size', 'version') and old/new are the VersionFile objects (None for
+        the side that does not exist). """
+        index = dict(other.index)
+        result = []
+        for new in self.filelist:
+            old = index.pop(new.sort_key, None)
+            if old is None:
+                result.append(('added', None, new))
+                continue
+            change = [field for field in ('crc32', 'size', 'version')
+                      if getattr(old, field) != getattr(new, field)]
+            if change:
+                result.append(('+'.join(change), old, new))
+        result.extend(('removed', old, None) for old in index.values())
+        return result
+
+
     def __repr__(self):
         return (f'VersionFile(header={repr(self.header)}, '
                 f'filelist=VersionFile[{len(self.filelist)}])')
 
 
+# the result of a file validated by FirmwareTree (see result2reason())
+FileResult = namedtuple('FileResult', ('path', 'name', 'code', 'reason'))
+
+
+class FirmwareTree:
+    """ An importable API over a firmware directory and its manifest
+
+    Validates (or updates) the files of the manifest in one process and
+    returns structured results instead of printing them, validate_trees()
+    handles several firmware directories at once; vertu.py is a thin
+    command line wrapper over it.  The options are those of the command
+    line (see VersionManifest).
+    """
+
+    def __init__(self, manifest, chunk_size=CHUNK_SIZE, use_mmap=False,
+                 jobs=1, split=1, cache=None, report=None):
+        self.manifest = VersionManifest(manifest, chunk_size, use_mmap, jobs,
+                                        split, cache, report)
+
+    def validate(self, update=False):
+        """ Returns the FileResult of every file in the manifest order, with
+        update the entries take the values of the files (see generate()) """
+        results = [FileResult(file.path, file.name, code,
+                              result2reason(code))
+                   for file, code in zip(self.manifest.filelist,
+                                         self.manifest.validate_files(update))]
+        if self.manifest.cache:
+            self.manifest.cache.save()
+        return results
+
+    def update(self, incremental=False):
+        """ Rebuilds the manifest from the firmware directory, returns the
+        same code as VersionManifest.update() """
+        return self.manifest.update(False, incremental)
+
+    def generate(self, filename=''):
+        self.manifest.generate(filename)
+
+    def diff(self, other):
+        """ Returns the changes from the other FirmwareTree """
+        return self.manifest.diff(other.manifest)
+
+
+def validate_trees(manifests, jobs=1, **options):
+    """ Lazy function (generator) to validate several firmware directories
+    concurrently, yields (manifest, FileResult list) in the given order; the
+    options are passed to every FirmwareTree """
+    def validate(manifest):
+        return FirmwareTree(manifest, **options).validate()
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        yield from zip(manifests, pool.map(validate, manifests))
+
+
+def print_diff(changes, firmware_dir, output_format='text'):
+    """ Prints the result of VersionManifest.diff() in the given format:
+    text, json, csv or paths (full paths of the added and changed files in
+    the firmware_dir of the new release, e.g. to pass on to xcrypt.py -f -) """
+    if output_format == 'paths':
+        for change, old, new in changes:
+            if new is not None:
+                print(os.path.join(firmware_dir, new.path, new.name))
+        return
+
+    def describe(file):
+        if file is None:
+            return None
+        return {'version': file.version, 'crc32': file.crc32,
+                'size': file.size}
+
+    rows = []
+    for change, old, new in changes:
+        file = new if new is not None else old
+        rows.append({'change': change,
+                     'path': file.path,
+                     'name': file.name,
+                     'old': describe(old),
+                     'new': describe(new)})
+
+    if output_format == 'json':
+        print(json.dumps(rows, indent=2))
+    elif output_format == 'csv':
+        writer = csv.writer(sys.stdout)
+        writer.writerow(['change', 'path', 'name',
+                         'old_version', 'old_crc32', 'old_size',
+                         'new_version', 'new_crc32', 'new_size'])
+        for row in rows:
+            values = [row['change'], row['path'], row['name']]
+            for side in (row['old'], row['new']):
+                values += ([side['version'], side['crc32'], side['size']]
+                           if side else ['', '', ''])
+            writer.writerow(values)
+    else:
+        marks = {'added': '+', 'removed': '-'}
+        for row in rows:
+            mark = marks.get(row['change'], '~')
+            line = f'{mark} {row["path"]}/{row["name"]}'
+            if mark == '~':
+                line += f' ({row["change"].replace("+", ", ")})'
+            print(line)
+
+
 def main():
     global print_v
 
@@ -311,30 +832,122 @@ def main():
                         help='validate the firmware directory against manifest')
     mode.add_argument('-u', '--update', action='store_true',
                         help='perform encryption')
+    mode.add_argument('--diff', type=str, dest='diff', metavar='OLD',
+                        help='list the differences between the OLD manifest '
+                             'and the given one')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='enable verbose output')
     parser.add_argument('-i', '--interactive', action='store_true',
                         help='ask user for permission to make changes')
+    parser.add_argument('-n', '--incremental', action='store_true',
+                        dest='incremental',
+                        help='only rehash new and changed files on update, '
+                             'keeping the other manifest entries as they are')
+    parser.add_argument('-b', '--block-size', type=int, dest='block_size',
+                        default=CHUNK_SIZE,
+                        help=f'sets the read buffer in bytes for CRC '
+                             f'calculations (default {CHUNK_SIZE})')
+    parser.add_argument('-m', '--mmap', action='store_true', dest='mmap',
+                        help='use memory mapped I/O for CRC calculations')
+    parser.add_argument('-j', '--jobs', type=int, dest='jobs', default=1,
+                        help='number of files to check in parallel '
+                             '(default 1, 0 means one per CPU)')
+    parser.add_argument('-s', '--split', type=int, dest='split', default=1,
+                        help='number of segments a large file is split into '
+                             'to calculate its CRC in parallel (default 1, '
+                             '0 means one per CPU)')
+    parser.add_argument('-c', '--cache', action='store_true', dest='cache',
+                        help='keep the calculated CRCs in a cache file next '
+                             'to the manifest (used automatically once it '
+                             'exists)')
+    parser.add_argument('--no-cache', action='store_true', dest='no_cache',
+                        help='do not use the CRC cache file')
+    parser.add_argument('--rehash', action='store_true', dest='rehash',
+                        help='recalculate all CRCs and refresh the cache file')
+    parser.add_argument('--journal', type=str, dest='journal', metavar='FILE',
+                        help='record the calculated CRCs into the journal as '
+                             'they come (instead of the cache file)')
+    parser.add_argument('--resume', action='store_true', dest='resume',
+                        help='resume an interrupted run from its journal, '
+                             'without hashing the files done already')
+    parser.add_argument('--report', type=str, dest='report', metavar='FILE',
+                        help='write the timings of every file and of its '
+                             'stages into the file as JSON lines, followed '
+                             'by a summary')
+    parser.add_argument('--summary', action='store_true', dest='summary',
+                        help='print a summary of the timings and the '
+                             'throughput at the end')
+    parser.add_argument('--format', type=str, dest='format',
+                        choices=['text', 'json', 'csv', 'paths'],
+                        default='text',
+                        help='output format of --diff (paths lists the full '
+                             'paths of added and changed files, e.g. for '
+                             'xcrypt.py -f -)')
     parser.add_argument('file', type=str,
                         help="a manifest file (usually a .ver file)")
     args = parser.parse_args()
 
     print_v = print if args.verbose else lambda *a, **k: None
 
+    if args.block_size <= 0:
+        print('ERROR: the specified block size should be a positive number!')
+        sys.exit(1)
+
+    if args.resume and not args.journal:
+        parser.error('resuming requires the journal of the run')
+    if args.journal and args.cache:
+        parser.error('the journal cannot be combined with the cache file')
+    if args.diff and (args.report or args.summary or args.journal):
+        parser.error('comparing the manifests does not calculate anything '
+                     'to report or to journal')
+
+    cache = None
+    cache_file = f'{os.path.abspath(args.file)}.crccache'
+    if args.journal:
+        cache = CrcJournal(args.journal, args.resume)
+    elif not args.no_cache and (args.cache or os.path.exists(cache_file)):
+        cache = CrcCache(cache_file, args.rehash)
+
+    report = None
+    if args.report or args.summary:
+        report = Report(args.report)
+
     print_v('Loading the manifest file ... ', end='')
-    manifest = VersionManifest(args.file)
+    tree = FirmwareTree(args.file, args.block_size, args.mmap,
+                        args.jobs if args.jobs > 0 else os.cpu_count() or 1,
+                        args.split if args.split > 0 else os.cpu_count() or 1,
+                        cache, report)
     print_v('done')
 
     result = 0
+    if args.diff:
+        print_v('Loading the other manifest file ... ', end='')
+        old_tree = FirmwareTree(args.diff)
+        print_v('done')
+        print_diff(tree.diff(old_tree), tree.manifest.firmware_dir,
+                   args.format)
+        return
+
+    # the interactive questions are asked by the manifest itself
     if args.update:
-        result = manifest.update(args.interactive)
+        result = tree.manifest.update(args.interactive, args.incremental)
     else:
-        result = manifest.validate(args.interactive)
+        result = tree.manifest.validate(args.interactive)
+
+    if args.journal:
+        cache.close()
+
+    if report:
+        report.close()
+        if args.summary:
+            print(report.table())
 
     if result == 0:
         print_v('\nAll done, the requested operation '
                 'successfully completed!\n')
 
+    sys.exit(result)
+
 
 if __name__ == '__main__':
     main()
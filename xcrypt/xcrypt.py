@@ -1,10 +1,27 @@
 #!/bin/env python
 import argparse
+import csv
+import errno
+import filecmp
+import io
+import json
+import mmap
 import os
+import queue
+import shutil
 import sys
+import threading
 import time
+import zlib
 
 from base64 import b64encode
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+try:
+    import fcntl
+except ImportError:     # not a POSIX platform, there are no reflinks
+    fcntl = None
 try:
     # Try PyCryptodome as standalone version
     from Cryptodome.Cipher import AES
@@ -14,11 +31,19 @@ except ModuleNotFoundError:
     from Crypto.Cipher import AES
     from Crypto.Hash import SHA256
 
-print_v = print
+# the shared instrumentation and vertu.py (for the manifests) are next to this
+for tool in ('instrument', 'vertu'):
+    sys.path.insert(0, os.path.join(
+        os.path.dirname(os.path.realpath(__file__)), os.pardir, tool))
+from instrument import JournalFile, Report, Throttle, current, timed
+
+print_v = lambda *a, **k: None    # verbose messages, enabled by main()
 KEY = '60a93d70f73302a63e5ed0d0ea38be22'
-IV = ''
 META_SIZE=0x4024    # size of the metadata blob
-PADDING=b''
+BLOCK_SIZE=16       # AES block size
+FICLONE=0x40049409  # the Linux ioctl reflinking a whole file
+SPLIT_MIN_SIZE=64*1024*1024 # smaller files are not worth splitting
+COPY_CHUNK_SIZE=64*1024*1024 # bytes per copy_file_range()/sendfile() call
 
 def hardware_int_view(value, bits, signed):
     base = 1 << bits
@@ -28,28 +53,38 @@ def hardware_int_view(value, bits, signed):
 def calculate_iv(file, size):
     basename = os.path.basename(file)
     print_v(f"Calculate IV for {basename} size {size}")
-    check_code = SHA256.new()
-    check_code.update(f'{basename}{hardware_int_view(size, 32, True)}'.encode('utf-8'))
-    return check_code.hexdigest()[:32]
+    with current().stage('iv'):
+        check_code = SHA256.new()
+        check_code.update(f'{basename}{hardware_int_view(size, 32, True)}'.encode('utf-8'))
+        return check_code.hexdigest()[:32]
 
-def perform_test(file):
-    global IV
-    global PADDING
+def perform_test(file, mapping=None):
+    """Checks the metadata of the file, the trailer is taken from the mapping
+    of the file if one is provided, otherwise it is read from the file."""
     result = 0xFF
 
-    with open(file, 'rb') as f:
-        f.seek(0, os.SEEK_END)
-        file_size = f.tell()
+    if mapping is not None:
+        file_size = len(mapping)
         if file_size <= META_SIZE:
             print_v(f'{file}: file is too small to be encrypted')
             return 0x01
+        metadata = mapping[file_size - META_SIZE:]
+    else:
+        with open(file, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            file_size = f.tell()
+            if file_size <= META_SIZE:
+                print_v(f'{file}: file is too small to be encrypted')
+                return 0x01
 
-        f.seek(file_size - META_SIZE, os.SEEK_SET)
-        metadata = f.read(META_SIZE)
-        if not metadata:
-            print_v(f'{file}: failed to read metadata from the file')
-            return 0x20
+            f.seek(file_size - META_SIZE, os.SEEK_SET)
+            metadata = f.read(META_SIZE)
 
+    return check_metadata(file, file_size, metadata)
+
+def check_signature(file, metadata):
+    """Checks the signature and the version at the start of the metadata,
+    returns 0 if it is supported or the perform_test() code otherwise"""
     if metadata[:2] != b'TE':
         print_v(f'{file}: metadata signature was not found')
         return 0x2
@@ -62,143 +97,1315 @@ def perform_test(file):
         print_v(f'{file}: unsupported version of metadata')
         return 0x8
 
-    IV = calculate_iv(file, file_size - META_SIZE)
+    return 0
+
+def check_metadata(file, file_size, metadata):
+    """Verifies the complete metadata read from the end of the file, returns
+    the same as perform_test()"""
+    if len(metadata) < META_SIZE:
+        print_v(f'{file}: failed to read metadata from the file')
+        return 0x20
+
+    result = check_signature(file, metadata)
+    if result:
+        return result
+
+    iv = calculate_iv(file, file_size - META_SIZE)
 
     check_code = SHA256.new()
-    check_code.update(bytes.fromhex(IV))
+    check_code.update(bytes.fromhex(iv))
     check_code.update(metadata[36:])
     if metadata[4:36] != check_code.digest():
         print_v(f'{file}: metadata integrity check failed')
         return 0x10
 
-    PADDING=metadata[36:52]             # let's save embedded padding vector
-
     result = {}
     result['file'] = file
     result['size'] = file_size - META_SIZE
     result['padding'] = metadata[36:52]
-    result['iv'] = IV
+    result['iv'] = iv
+    result['metadata'] = metadata
     return result
 
-def perform_encrypt(block, cipher, check_code):
-    BLOC=16
-    index = 0
-    encd = b''
+def read_at(fd, size, offset):
+    """Reads up to size bytes from the given file position, with os.pread()
+    where the platform has it"""
+    if hasattr(os, 'pread'):
+        return os.pread(fd, size, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+def scan_file(file):
+    """A faster perform_test() for scanning many files: only the signature is
+    read at first and the rest of the metadata is read and verified only if
+    it is found.  Returns the size of the file and the perform_test() code
+    (0 if the file is encrypted)."""
+    fd = os.open(file, os.O_RDONLY)
+    try:
+        file_size = os.fstat(fd).st_size
+        if file_size <= META_SIZE:
+            print_v(f'{file}: file is too small to be encrypted')
+            return file_size, 0x01
+        result = check_signature(
+            file, read_at(fd, 3, file_size - META_SIZE).ljust(3, b'\0'))
+        if not result:
+            result = check_metadata(file, file_size, read_at(
+                fd, META_SIZE, file_size - META_SIZE))
+        return file_size, result if isinstance(result, int) else 0
+    finally:
+        os.close(fd)
 
-    pad = 0
-    if (len(block) % BLOC) > 0:
-        pad = BLOC - len(block) % BLOC
-        block += b'\0' * pad
+def build_metadata(check_code, padding):
+    """Builds the TE2 metadata blob that follows the encrypted data.
 
-    while index < len(block):
-        encd += cipher.encrypt(block[index:index+BLOC])
-        index += BLOC
+    The padding is the part of the last ciphertext block that did not fit
+    into the size of the original file (empty for 16 bytes aligned files) and
+    the check_code is the SHA256 object already seeded with the IV."""
+    metadata = bytearray(META_SIZE)
+    metadata[0:3] = b'TE2'
+    metadata[36:36+len(padding)] = padding
+    check_code.update(metadata[36:])
+    metadata[4:36] = check_code.digest()
+    return metadata
+
+
+def perform_encrypt(block, cipher, check_code, output=None):
+    """Encrypts a chunk with a single cipher call per contiguous range.
+
+    Only a short final block is handled separately: it is padded with zeros
+    and encrypted on its own.  The result is written into the output buffer
+    (allocated if not provided) and a view of the written part is returned."""
+    tail = len(block) % BLOCK_SIZE
+    aligned = len(block) - tail
+    size = aligned + (BLOCK_SIZE if tail else 0)
+    if output is None:
+        output = bytearray(size)
+    encd = memoryview(output)[:size]
+
+    if aligned:
+        cipher.encrypt(memoryview(block)[:aligned], output=encd[:aligned])
+    if tail:
+        last = bytearray(BLOCK_SIZE)
+        last[:tail] = block[aligned:]
+        cipher.encrypt(last, output=encd[aligned:])
 
     return encd
 
 
-def perform_decrypt(block, cipher, param):
-    BLOC=16
-    index = 0
-    decd = b''
+def perform_decrypt(block, cipher, padding, output=None):
+    """Decrypts a chunk with a single cipher call per contiguous range.
+
+    A short final block is completed with the embedded padding vector from
+    the metadata (passed in as padding), decrypted on its own and then
+    trimmed back.  The result is written into the output buffer (allocated
+    if not provided) and a view of the written part is returned."""
+    tail = len(block) % BLOCK_SIZE
+    aligned = len(block) - tail
+    if output is None:
+        output = bytearray(len(block))
+    decd = memoryview(output)[:len(block)]
+
+    if aligned:
+        cipher.decrypt(memoryview(block)[:aligned], output=decd[:aligned])
+    if tail:
+        last = bytearray(block[aligned:]) + padding[:BLOCK_SIZE - tail]
+        decd[aligned:] = cipher.decrypt(last)[:tail]
 
-    #print(f' {len(block)}:{len(block) % BLOC}')
-    pad = 0
-    if (len(block) % BLOC) > 0:
-        #print(f'short block: {len(block)} by {len(block)%BLOC}')
-        pad = BLOC - len(block) % BLOC
-        #block += bytes.fromhex('83d1d2324f8a69f889f8')
-        block += PADDING[:pad]
-        #print(f'padded by {pad} bytes to total {len(block)} ({PADDING[:pad].hex()})')
+    return decd
 
-    while index < len(block):
-        decd += cipher.decrypt(block[index:index+BLOC])
-        index += BLOC
-    return decd[:len(block) - pad]
 
+def default_block_size(size):
+    """Picks a read buffer size (a multiple of 16) suitable for the file size"""
+    if size <= 256*1024:
+        return 64*1024
+    if size <= 64*1024*1024:
+        return 1024*1024
+    return 4*1024*1024
 
-def read_in_chunks(file_object, chunk_size=4*1024, limit = -1):
+
+def read_in_chunks(file_object, chunk_size=4*1024, limit = -1, buffer=None):
     """Lazy function (generator) to read a file piece by piece.
-    Default chunk size: 1MB."""
-    ptr = 0
-    while True:
-        data = file_object.read(chunk_size)
-        if not data:
-            #print(f'end of file, read {ptr} chunks of {chunk_size} with limit set to {limit}')
-            break
-        ptr = ptr + 1
-        if limit > 0 and len(data) > limit - (ptr-1)*chunk_size:
-            #print_v('processing truncated block')
-            #print(f'read {ptr-1} chunks of {chunk_size} + {len(data)} with limit set to {limit}')
-            #print(f'giving out {limit - (ptr-1)*chunk_size}')
-            yield data[:limit - (ptr-1)*chunk_size]
+
+    The data is read with readinto() into a single reusable buffer (allocated
+    if not provided, may be larger than chunk_size) and every chunk is handed
+    out as a memoryview into that buffer, so it is only valid until the next
+    iteration.  If limit is set, reading stops after that many bytes."""
+    if buffer is None:
+        buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    remaining = limit
+    while remaining != 0:
+        want = chunk_size if remaining < 0 else min(chunk_size, remaining)
+        length = file_object.readinto(view[:want])
+        if not length:
             break
-        yield data
+        if remaining > 0:
+            remaining -= length
+        yield view[:length]
 
 
-def process_block(mode, block, cipher, param):
-    return mode(block, cipher, param)
+class Pipeline:
+    """ Overlaps reading, the cipher and writing of a file
+
+    A reader thread fills free buffers with readinto() and queues them for
+    the cipher stage (whoever iterates over the pipeline), a writer thread
+    writes the processed chunks passed to write() and returns the buffers to
+    the free pool.  AES and file I/O release the GIL, so the disk and the CPU
+    work at the same time.  The number of buffers bounds the queues: two give
+    double buffering, three triple buffering.  Every chunk is a memoryview
+    into a buffer that has a spare AES block at its end (see process_file()).
+    """
+
+    def __init__(self, file_in, file_out, chunk_size, limit=-1, buffers=3):
+        self.file_in = file_in
+        self.file_out = file_out
+        self.chunk_size = chunk_size
+        self.limit = limit
+        self._free = queue.Queue()
+        for count in range(max(buffers, 2)):
+            self._free.put(bytearray(chunk_size + BLOCK_SIZE))
+        self._loaded = queue.Queue()
+        self._processed = queue.Queue()
+        self._stop = False
+        self._error = None
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._writer = threading.Thread(target=self._write, daemon=True)
+
+    def _read(self):
+        remaining = self.limit
+        try:
+            while remaining != 0 and not self._stop:
+                buffer = self._free.get()
+                if buffer is None:
+                    break
+                want = (self.chunk_size if remaining < 0
+                        else min(self.chunk_size, remaining))
+                length = self.file_in.readinto(memoryview(buffer)[:want])
+                if not length:
+                    break
+                if remaining > 0:
+                    remaining -= length
+                self._loaded.put(memoryview(buffer)[:length])
+        except Exception as err:
+            self._loaded.put(err)
+            return
+        self._loaded.put(None)
+
+    def _write(self):
+        while True:
+            data = self._processed.get()
+            if data is None:
+                return
+            try:
+                if not self._error:
+                    self.file_out.write(data)
+            except Exception as err:
+                self._error = err
+            self._free.put(data.obj)
+
+    def __enter__(self):
+        self._reader.start()
+        self._writer.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop = True
+        self._free.put(None)        # wakes up the reader waiting for a buffer
+        self._processed.put(None)
+        self._writer.join()
+        self._reader.join()
+        if self._error and not exc_type:
+            raise self._error
+
+    def __iter__(self):
+        while True:
+            block = self._loaded.get()
+            if block is None:
+                return
+            if isinstance(block, Exception):
+                raise block
+            yield block
+
+    def write(self, data):
+        """Queues a processed chunk (a view into a pipeline buffer)"""
+        if self._error:
+            raise self._error
+        self._processed.put(data)
+
+
+def process_block(mode, block, cipher, param, output=None):
+    return mode(block, cipher, param, output)
 
 def update_progress(file, size, block):
     count = 0
+    due = Throttle()    # a terminal write per block would slow small blocks
     while size > count * block:
         count += 1
         percent = (count * block * 100) / size
         # out block is bigger than actual data read
         percent = min(percent, 100.0)
-        print_v(f'\r{file} .. {percent:3.0f}%', end='')
+        if due() or percent == 100.0:
+            print_v(f'\r{file} .. {percent:3.0f}%', end='')
         yield percent
     yield 100   # this assures that we never run out of data for the progress
 
-def process_file(mode, file, block_size, output):
-    #file_size = os.path.getsize(file)
+def pread_into(fd, view, offset):
+    """Fills the view from the given file position, returns the bytes read"""
+    length = 0
+    while length < len(view):
+        count = os.preadv(fd, [view[length:]], offset + length)
+        if not count:
+            break
+        length += count
+    return length
+
+
+def pwrite_from(fd, view, offset):
+    """Writes the whole view at the given file position"""
+    length = 0
+    while length < len(view):
+        length += os.pwrite(fd, view[length:], offset + length)
+
+
+def decrypt_range(fd_in, fd_out, start, end, iv, padding, block_size):
+    """Decrypts the [start, end) range of the ciphertext in place.
+
+    CBC decryption of a block only needs the previous ciphertext block, so a
+    range can be decrypted on its own once the cipher is seeded with the
+    block just before the range (or the file IV for the very first range).
+    The plaintext is written at the same position of the output file."""
+    if start:
+        iv = os.pread(fd_in, BLOCK_SIZE, start - BLOCK_SIZE)
+    cipher = AES.new(bytes.fromhex(KEY), AES.MODE_CBC, iv)
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    offset = start
+    while offset < end:
+        length = pread_into(fd_in, view[:min(block_size, end - offset)], offset)
+        if not length:
+            raise EOFError(f'unexpected end of file at {offset}')
+        # only the last range can end with a short block
+        pwrite_from(fd_out, perform_decrypt(view[:length], cipher, padding,
+                                            buffer), offset)
+        offset += length
+
+
+def decrypt_split(file, output, file_size, iv, padding, block_size, split):
+    """Decrypts a large file as split ranges processed in parallel"""
+    step = -(-file_size // split)
+    step += -step % BLOCK_SIZE          # ranges must start on a block boundary
+    print_v(f'\r{file}: decrypting in {-(-file_size // step)} parallel ranges')
+    with open(file, 'rb') as file_in, open(output, 'xb') as file_out:
+        os.ftruncate(file_out.fileno(), file_size)
+        with ThreadPoolExecutor(max_workers=split) as pool:
+            futures = [pool.submit(decrypt_range, file_in.fileno(),
+                                   file_out.fileno(), start,
+                                   min(start + step, file_size), iv, padding,
+                                   block_size)
+                       for start in range(0, file_size, step)]
+            for future in futures:
+                future.result()
+    return 0
+
+
+def encryption_iv(file, file_size, output, iv_name=None):
+    """Derives the IV to encrypt the file with from iv_name (or output)"""
+    name_for_iv = iv_name if iv_name else output
+    if name_for_iv == file:
+        print_v(f"Warning: because no specific output name was specified, the file will be encrypted using the input file name ({os.path.basename(name_for_iv)}), since it is assumed you will have to rename it from the final .out.")
+    return bytes.fromhex(calculate_iv(name_for_iv, file_size))
+
+
+def process_file_mmap(mode, file, block_size, output, iv_name=None,
+                      progress=True, mirror=False):
+    """Encrypts or decrypts a file using memory mapped I/O.
+
+    The input is mapped once, the metadata is checked straight from that
+    mapping and the data is processed from it directly into a pre-sized,
+    memory mapped output file.  Returns the same codes as process_file()."""
+    with open(file, 'rb') as file_in:
+        total = os.fstat(file_in.fileno()).st_size
+        if not total:   # empty files cannot be mapped
+            return process_file(mode, file, block_size, output, iv_name,
+                                progress, mirror=mirror)
+        with mmap.mmap(file_in.fileno(), 0,
+                       access=mmap.ACCESS_READ) as mapping:
+            if mode == perform_decrypt:
+                with current().stage('metadata'):
+                    metadata = perform_test(file, mapping)
+                if mirror and metadata in (0x01, 0x02):
+                    return mirror_file(file, output)
+                if isinstance(metadata, int) and metadata != 0:
+                    print_v(f'\r{file} is either unencrypted or damaged')
+                    return metadata
+                file_size = metadata['size']
+                out_size = file_size
+                iv = bytes.fromhex(metadata['iv'])
+                param = metadata['padding']
+            elif mode == perform_encrypt:
+                file_size = total
+                out_size = file_size + META_SIZE
+                iv = encryption_iv(file, file_size, output, iv_name)
+                param = SHA256.new()
+                param.update(iv)
+
+            if not block_size:
+                block_size = default_block_size(file_size)
+
+            with open(output, 'xb+') as file_out:
+                file_out.truncate(out_size)
+                with mmap.mmap(file_out.fileno(), out_size) as target_map, \
+                        memoryview(mapping) as source, \
+                        memoryview(target_map) as target:
+                    cipher = AES.new(bytes.fromhex(KEY), AES.MODE_CBC, iv)
+                    if progress:
+                        print_v('\r\033[K', end='')
+                        progress = update_progress(file, file_size, block_size)
+                    aligned = file_size - file_size % BLOCK_SIZE
+                    crypto = current().stage('crypto')  # page faults included
+                    for start in range(0, aligned, block_size):
+                        end = min(start + block_size, aligned)
+                        with crypto:
+                            mode(source[start:end], cipher, param,
+                                 target[start:end])
+                        if progress:
+                            percent = next(progress)
 
+                    padding = b''
+                    if aligned < file_size:
+                        # the short final block is handled on its own, for
+                        # encryption the part beyond the file size is stored
+                        # in the metadata
+                        last = mode(source[aligned:file_size], cipher, param)
+                        target[aligned:file_size] = last[:file_size - aligned]
+                        padding = bytes(last[file_size - aligned:])
+                        del last
+                    if progress:
+                        print_v('\r', end='')
+
+                    if mode == perform_encrypt:
+                        target[file_size:] = build_metadata(param, padding)
+
+    return 0
+
+
+class CrcWriter:
+    """ Wraps an output file to calculate the CRC32 and size of the data
+    written into it on the fly """
+
+    def __init__(self, file_out):
+        self.file_out = file_out
+        self.crc32 = 0
+        self.size = 0
+
+    def write(self, data):
+        self.crc32 = zlib.crc32(data, self.crc32)
+        self.size += len(data)
+        return self.file_out.write(data)
+
+
+def open_output(output):
+    """Opens a new output file for writing, '-' is the standard output"""
+    if output == '-':
+        return open(sys.__stdout__.fileno(), 'wb', closefd=False)
+    return open(output, 'xb')
+
+
+def process_file(mode, file, block_size, output, iv_name=None, progress=True,
+                 split=1, use_mmap=False, pipeline=0, check=None, written=None,
+                 mirror=False):
+    """Encrypts or decrypts a file, block_size of None selects it automatically.
+
+    All the state needed for the file (IV, padding vector) is kept locally, so
+    several files can be processed concurrently.  The IV for encryption is
+    derived from iv_name (the output name by default).  The output is written
+    in a single forward pass, so it can be a pipe ('-' is the standard
+    output).  Decryption of a file of at least SPLIT_MIN_SIZE bytes is spread
+    over split parallel ranges, otherwise use_mmap selects memory mapped I/O
+    (see process_file_mmap()) and a non-zero pipeline overlaps the I/O with
+    the cipher using that many buffers (see Pipeline).
+
+    The check is an optional (size, crc32) pair the encrypted input has to
+    match (e.g. from the manifest): the CRC32 is calculated over the same
+    chunks that are decrypted, so the file is read only once.  Returns 0 on
+    success, the perform_test() code of a file that cannot be decrypted or
+    0x80 if the file does not match the check (the output is removed).
+
+    If written is a dictionary, the CRC32 and size of the produced output
+    are stored into it (as 'crc32' and 'size') while it is being written.
+
+    With mirror, an unencrypted file is copied into the output as it is
+    (see mirror_file()) rather than being reported."""
+
+    if output == '-' or check or written is not None:
+        use_mmap = False    # positional writes need a real file, the check and
+        split = 1           # the output CRC need to see the data in order
+
+    if check and os.path.getsize(file) != check[0]:
+        print_v(f'\r{file}: size does not match the manifest')
+        return 0x80
+
+    if use_mmap and not (mode == perform_decrypt and split > 1
+                         and os.path.getsize(file) >= SPLIT_MIN_SIZE):
+        return process_file_mmap(mode, file, block_size, output, iv_name,
+                                 progress, mirror)
+
+    record = current()
     if mode == perform_decrypt:
-        metadata = perform_test(file)   # this extracts and populates IV
+        with record.stage('metadata'):
+            metadata = perform_test(file)   # this extracts IV and padding
+        if mirror and metadata in (0x01, 0x02):
+            return mirror_file(file, output, check)
         if isinstance(metadata, int) and metadata != 0:
-            print(f'\r{file} is either unencrypted or damaged (use -v -t to see the details)')
-            return
+            print_v(f'\r{file} is either unencrypted or damaged')
+            return metadata
         file_size = metadata['size']
         iv = bytes.fromhex(metadata['iv'])
-        param = ''
+        param = metadata['padding']
     elif mode == perform_encrypt:
         file_size = os.path.getsize(file)
-        name_for_iv = output if args.output else file
-        if name_for_iv == file:
-            print(f"Warning: because no specific output name was specified, the file will be encrypted using the input file name ({os.path.basename(name_for_iv)}), since it is assumed you will have to rename it from the final .out.")
-        iv = bytes.fromhex(calculate_iv(name_for_iv, file_size))
+        iv = encryption_iv(file, file_size, output, iv_name)
         param = SHA256.new()
         param.update(iv)
 
+    if not block_size:
+        block_size = default_block_size(file_size)
+
+    if (mode == perform_decrypt and split > 1
+            and file_size >= SPLIT_MIN_SIZE and hasattr(os, 'pwrite')):
+        with record.stage('crypto'):    # the parallel I/O included
+            return decrypt_split(file, output, file_size, iv, param,
+                                 block_size, split)
+
     with open(file, 'rb') as file_in:
-        with open(output, 'xb+') as file_out:
+        with open_output(output) as file_out:
+            if written is not None:
+                file_out = CrcWriter(file_out)
             cipher = AES.new(bytes.fromhex(KEY), AES.MODE_CBC, iv)
-            print_v('\r\033[K', end='')
-            progress = update_progress(file, file_size, block_size)
-            for block in read_in_chunks(file_in, block_size, file_size):
-                file_out.write(process_block(mode, block, cipher, param))
-                percent = next(progress)
-            print_v('\r', end='')
+            if progress:
+                print_v('\r\033[K', end='')
+                progress = update_progress(file, file_size, block_size)
+            started = time.perf_counter()
+            stages = None
+            if pipeline:
+                stages = Pipeline(file_in, file_out, block_size, file_size,
+                                  pipeline)
+            padding = b''
+            crc32 = 0
+            # with the pipeline, read and write are the waits for its threads
+            crc, crypto, writing = (record.stage('crc'),
+                                    record.stage('crypto'),
+                                    record.stage('write'))
+            with stages or nullcontext():
+                if stages:
+                    chunks = stages
+                    write = stages.write
+                else:
+                    chunks = read_in_chunks(file_in, block_size, file_size,
+                                            bytearray(block_size + BLOCK_SIZE))
+                    write = file_out.write
+                for block in timed(chunks, 'read'):
+                    if check:   # the CRC is of the data as it is on the disk
+                        with crc:
+                            crc32 = zlib.crc32(block, crc32)
+                    # the spare block at the end of the buffer behind the chunk
+                    # leaves room for padding the final short block, so the
+                    # crypto happens in place and is written from the buffer
+                    with crypto:
+                        data = process_block(mode, block, cipher, param,
+                                             block.obj)
+                    if len(data) > len(block):
+                        # the encrypted final block does not fit the file
+                        # size, the rest of it goes into the metadata
+                        padding = bytes(data[len(block):])
+                        data = data[:len(block)]
+                    with writing:
+                        write(data)
+                    if progress:
+                        percent = next(progress)
+            if progress:
+                print_v('\r', end='')
+            if stages:
+                elapsed = time.perf_counter() - started
+                print_v(f'{file}: {file_size / max(elapsed, 1e-9) / 1e6:.1f} '
+                        f'MB/s with {pipeline} pipeline buffers')
 
             if mode == perform_encrypt:
-                metadata = bytearray(META_SIZE-1) # META_SIZE
-                metadata[0:2] = b'TE2'
-                pad = 16 - file_size % 16
-                if pad > 0:
-                    file_out.seek(-pad, os.SEEK_END)
-                    padding = file_out.read(pad)
-                    metadata[36:36+pad] = padding
-                    file_out.seek(-pad, os.SEEK_END)
+                file_out.write(build_metadata(param, padding))
+
+            if written is not None:
+                written['crc32'] = file_out.crc32
+                written['size'] = file_out.size
+
+    if check and zlib.crc32(metadata['metadata'], crc32) != check[1]:
+        print_v(f'\r{file}: CRC32 does not match the manifest')
+        if output != '-':
+            os.unlink(output)
+        return 0x80
+
+    return 0
+
+
+def reflink(fd_in, fd_out):
+    """Makes the output a reflink of the whole input, returns False if the
+    filesystem (or the platform) does not support that"""
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(fd_out, FICLONE, fd_in)
+        return True
+    except OSError:
+        return False    # not supported or not the same filesystem
+
+
+def clone_file(source, target):
+    """Copies a file without passing the data through the user space: the
+    target is a reflink of the source where the filesystem supports it,
+    otherwise the kernel copies the data with os.copy_file_range() (or
+    os.sendfile() if that is not possible, e.g. into a pipe).  Platforms
+    with neither copy the data in the user space."""
+    with open(source, 'rb') as file_in, open_output(target) as file_out:
+        fd_in, fd_out = file_in.fileno(), file_out.fileno()
+        if reflink(fd_in, fd_out):
+            return
+
+        copy = getattr(os, 'copy_file_range', None)
+        if not copy and not hasattr(os, 'sendfile'):
+            shutil.copyfileobj(file_in, file_out, COPY_CHUNK_SIZE)
+            return
+        while True:
+            try:
+                if copy:
+                    copied = copy(fd_in, fd_out, COPY_CHUNK_SIZE)
+                else:
+                    copied = os.sendfile(fd_out, fd_in, None,
+                                         COPY_CHUNK_SIZE)
+            except OSError as err:
+                if not copy or err.errno not in (
+                        errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+                        errno.EOPNOTSUPP, errno.EBADF):
+                    raise
+                copy = None
+                continue
+            if not copied:
+                break
+
+
+def mirror_file(file, output, check=None):
+    """Copies an unencrypted file into the output as it is (see clone_file()),
+    if there is a check (see process_file()) the data is verified while it
+    is being copied instead.  Returns the same codes as process_file()."""
+    print_v(f'\r{file} is not encrypted, copying it as it is')
+    if not check:
+        with current().stage('copy'):
+            clone_file(file, output)
+        return 0
+
+    written = {}
+    with current().stage('copy'):
+        copy_file(file, output, written)
+    if (written['size'], written['crc32']) != tuple(check):
+        print_v(f'\r{file}: CRC32 does not match the manifest')
+        if output != '-':
+            os.unlink(output)
+        return 0x80
+    return 0
+
+
+class PlainCache:
+    """A directory with decrypted files shared between firmware releases.
+
+    The entries are keyed by the metadata check code, the last ciphertext
+    block (with CBC it depends on all the data) and the size, so a file that
+    has already been decrypted once is linked into the output rather than
+    decrypted again: reflinked where the filesystem supports it, hard linked
+    otherwise (the entries are read-only for that reason).  The last use of
+    an entry is marked by the modification time of an empty file of the same
+    name in the used subdirectory (the entries themselves share the inode,
+    and so the times, with the outputs linked to them), trim() evicts the
+    least recently used ones to keep the cache within the limit."""
+
+    def __init__(self, directory, limit=0):
+        self.directory = directory
+        self.used = os.path.join(directory, 'used')
+        self.limit = limit      # in bytes, 0 means no limit
+        os.makedirs(self.used, exist_ok=True)
+
+    def key(self, file, metadata):
+        """Returns the key of the encrypted file (see perform_test())"""
+        size = metadata['size']
+        with open(file, 'rb') as file_in:
+            last_block = read_at(file_in.fileno(), min(size, BLOCK_SIZE),
+                                 max(size - BLOCK_SIZE, 0))
+        check_code = SHA256.new(metadata['metadata'][4:36] + last_block)
+        return f'{check_code.hexdigest()}-{size}'
+
+    def fetch(self, key, output):
+        """Links the cached plaintext to the output, returns False if there
+        is none"""
+        path = os.path.join(self.directory, key)
+        if not os.path.exists(path):
+            return False
+        self.touch(key)
+        with open(path, 'rb') as file_in, open(output, 'xb') as file_out:
+            if reflink(file_in.fileno(), file_out.fileno()):
+                return True
+        os.unlink(output)
+        try:
+            os.link(path, output)
+        except OSError:     # e.g. another filesystem
+            clone_file(path, output)
+        return True
+
+    def store(self, key, output):
+        """Adds the decrypted output to the cache"""
+        path = os.path.join(self.directory, key)
+        if os.path.exists(path):
+            return
+        temp = f'{path}.{threading.get_ident()}.tmp'
+        if os.path.exists(temp):
+            os.unlink(temp)     # left behind by an interrupted run
+        clone_file(output, temp)
+        os.chmod(temp, 0o444)
+        os.replace(temp, path)
+        self.touch(key)
+
+    def touch(self, key):
+        """Marks the entry as just used"""
+        marker = os.path.join(self.used, key)
+        with open(marker, 'a'):
+            pass
+        os.utime(marker)
+
+    def trim(self):
+        """Evicts the least recently used entries over the limit"""
+        if not self.limit:
+            return
+        entries = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    try:
+                        used = os.stat(os.path.join(self.used, entry.name))
+                    except FileNotFoundError:
+                        used = stat     # not marked, e.g. an older cache
+                    entries.append((used.st_mtime_ns, stat.st_size,
+                                    entry.name))
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.limit:
+                break
+            print_v(f'evicting "{name}" from the cache')
+            os.unlink(os.path.join(self.directory, name))
+            try:
+                os.unlink(os.path.join(self.used, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class Journal:
+    """An append-only journal of the files completed by a batch run.
+
+    Every line is a JSON object with the input (path, size and modification
+    time) and the output (path, size, modification time and CRC32) of a
+    file.  When a run is resumed, a file is skipped while both are still the
+    same as in the journal; a torn last line of an interrupted run is
+    ignored.  Without resuming, the journal is started afresh."""
+
+    def __init__(self, filename, resume=False):
+        self.resume = resume
+        self.journal = JournalFile(filename, resume, ('file', 'crc32'))
+        if self.journal.damaged:
+            print_v(f'Ignoring {self.journal.damaged} damaged line(s) of '
+                    f'"{filename}"')
+        self.entries = {entry['file']: entry
+                        for entry in self.journal.entries}
 
-                param.update(metadata[36:])
-                metadata[4:36] = param.digest()
-                file_out.write(metadata)
+    @staticmethod
+    def entry(file, output, crc32=None):
+        stat, output_stat = os.stat(file), os.stat(output)
+        return {
+            'file': os.path.abspath(file),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'output': os.path.abspath(output),
+            'output_size': output_stat.st_size,
+            'output_mtime_ns': output_stat.st_mtime_ns,
+            'crc32': crc32,
+        }
 
+    def complete(self, file, output):
+        """Tells whether the output of the file is complete and unchanged"""
+        known = self.entries.get(os.path.abspath(file))
+        if known is None:
+            return False
+        try:
+            return self.entry(file, output, known['crc32']) == known
+        except OSError:
+            return False
+
+    def record(self, file, output, crc32):
+        self.journal.append(self.entry(file, output, crc32))
+
+    def close(self):
+        self.journal.close()
+
+
+def file_crc32(file):
+    """Calculates the CRC32 of the whole file"""
+    crc32 = 0
+    with open(file, 'rb', buffering=0) as file_in:
+        for block in read_in_chunks(file_in, default_block_size(
+                os.fstat(file_in.fileno()).st_size)):
+            crc32 = zlib.crc32(block, crc32)
+    return crc32
+
+
+class DecryptedFile(io.RawIOBase):
+    """ A read-only, seekable file object over the plaintext of an encrypted file
+
+    The plaintext is decrypted on demand in pages (a multiple of 16 bytes),
+    each page using the ciphertext block in front of it as the IV, and the
+    most recently used pages are kept in a small LRU cache.  This allows to
+    look into a large image (e.g. with tarfile) without decrypting all of it.
+    """
+
+    def __init__(self, file, page_size=64*1024, cache_pages=16):
+        if page_size <= 0 or page_size % BLOCK_SIZE:
+            raise ValueError('page size should be dividable by 16')
+        metadata = perform_test(file)
+        if isinstance(metadata, int):
+            raise ValueError(f'{file} is either unencrypted or damaged '
+                             f'(code 0x{metadata:02x})')
+        super().__init__()
+        self.name = file
+        self.size = metadata['size']
+        self.page_size = page_size
+        self.cache_pages = max(cache_pages, 1)
+        self._iv = bytes.fromhex(metadata['iv'])
+        self._padding = metadata['padding']
+        self._file = open(file, 'rb')
+        self._pages = OrderedDict()
+        self._pos = 0
+
+    def _page(self, index):
+        """Returns the plaintext of the page, decrypting it if not cached"""
+        page = self._pages.get(index)
+        if page is not None:
+            self._pages.move_to_end(index)
+            return page
+
+        start = index * self.page_size
+        end = min(start + self.page_size, self.size)
+        iv = self._iv
+        if start:
+            # the previous ciphertext block is the IV of this page
+            self._file.seek(start - BLOCK_SIZE)
+            iv = self._file.read(BLOCK_SIZE)
+        else:
+            self._file.seek(0)
+        page = bytearray(end - start)
+        if self._file.readinto(page) != len(page):
+            raise EOFError(f'{self.name}: unexpected end of file at {start}')
+        cipher = AES.new(bytes.fromhex(KEY), AES.MODE_CBC, iv)
+        perform_decrypt(page, cipher, self._padding, page)
+
+        self._pages[index] = page
+        if len(self._pages) > self.cache_pages:
+            self._pages.popitem(last=False)
+        return page
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        view = memoryview(buffer).cast('B')
+        length = 0
+        while length < len(view) and self._pos < self.size:
+            index, offset = divmod(self._pos, self.page_size)
+            page = self._page(index)
+            count = min(len(page) - offset, len(view) - length)
+            view[length:length + count] = page[offset:offset + count]
+            length += count
+            self._pos += count
+        return length
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        elif whence != os.SEEK_SET:
+            raise ValueError(f'invalid whence ({whence})')
+        if offset < 0:
+            raise ValueError(f'negative seek position {offset}')
+        self._pos = offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+            self._pages.clear()
+        super().close()
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}('
+                f'name="{self.name}", '
+                f'size={self.size}, '
+                f'page_size={self.page_size})')
+
+
+def output_name(file, output):
+    """Works out where the result of processing the file should be stored"""
+    if not output:
+        return f'{file}.out'
+    if output != '-' and output[-1] == "/":
+        output_file = os.path.join(output, os.path.relpath(file))
+        if not os.path.isdir(os.path.dirname(output_file)):
+            print_v(f'creating output directory "{output}"')
+            os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        return output_file
+    return output
+
+
+def run_file(mode, file, block_size, output_file, iv_name, progress=True,
+             split=1, use_mmap=False, pipeline=0, check=None, mirror=False,
+             cache=None, report=None, journal=None):
+    """Performs the selected operation on a single file and returns its code,
+    decrypted files are looked up in and added to the cache if there is one.
+    With a report, the timings of the file are recorded into it.
+
+    The output is written under a temporary name and renamed once complete,
+    so an interrupted run never leaves a partial output behind; completed
+    files are recorded into the journal (and skipped if it resumes a run)."""
+    if report is None:
+        return run_file_untimed(mode, file, block_size, output_file, iv_name,
+                                progress, split, use_mmap, pipeline, check,
+                                mirror, cache, journal)
+    try:
+        size = os.path.getsize(file)
+    except OSError:
+        size = 0
+    with report.file(file, size) as record:
+        record.result = run_file_untimed(mode, file, block_size, output_file,
+                                         iv_name, progress, split, use_mmap,
+                                         pipeline, check, mirror, cache,
+                                         journal)
+    return record.result
+
+
+def run_file_untimed(mode, file, block_size, output_file, iv_name, progress,
+                     split, use_mmap, pipeline, check, mirror, cache,
+                     journal=None):
+    """The body of run_file() without the timing"""
+    if mode == perform_test:
+        try:
+            with current().stage('metadata'):
+                return scan_file(file)[1]
+        except OSError as err:
+            print_v(f'\r{file}: {err.strerror or err}')
+            return 0x40
+
+    if output_file == '-':
+        target = output_file
+    else:
+        if journal and journal.complete(file, output_file):
+            print_v(f'\r{file}: already done in the resumed run, skipping')
+            return 0
+        if os.path.exists(output_file) and not (journal and journal.resume):
+            print_v(f'\r{file}: {output_file} already exists')
+            return 0x40
+        target = f'{output_file}.part'
+        iv_name = iv_name or output_file    # not the temporary name
+    # the output CRC for the journal comes for free on the stream path
+    written = {} if journal and not (use_mmap or split > 1) else None
+
+    try:
+        if target != output_file and os.path.exists(target):
+            os.unlink(target)   # left behind by an interrupted run
+        key = None
+        result = None
+        if cache and mode == perform_decrypt and target != '-':
+            with current().stage('cache'):
+                metadata = perform_test(file)
+                if isinstance(metadata, dict):
+                    key = cache.key(file, metadata)
+                    if (not check
+                            or (os.path.getsize(file), file_crc32(file))
+                            == tuple(check)) and cache.fetch(key, target):
+                        print_v(f'\r{file}: found in the cache')
+                        result = 0
+                        key = None
+        if result is None:
+            result = process_file(mode, file, block_size, target, iv_name,
+                                  progress, split, use_mmap, pipeline, check,
+                                  written, mirror)
+        if result or target == output_file:
+            return result
+
+        os.replace(target, output_file)
+        if key:
+            with current().stage('cache'):
+                cache.store(key, output_file)
+        if journal:
+            journal.record(file, output_file, written['crc32'] if written
+                           else file_crc32(output_file))
+        return 0
+    except (OSError, EOFError) as err:
+        print_v(f'\r{file}: {getattr(err, "strerror", None) or err}')
+        return 0x40
+    finally:
+        if target != output_file and os.path.exists(target):
+            os.unlink(target)
+
+
+def run_files(mode, tasks, block_size, jobs=1, split=1, use_mmap=False,
+              pipeline=0, mirror=False, cache=None, report=None, journal=None):
+    """Lazy function (generator) to process (file, output, iv_name, check)
+    tasks (see process_file()).
+
+    With more than one job the files are processed on a thread pool (AES,
+    hashing and file I/O all release the GIL) with the largest files
+    scheduled first, so a single huge image does not end up running alone
+    at the end.  Either way, the codes are yielded in the order of tasks."""
+    if jobs <= 1:
+        for file, output_file, iv_name, check in tasks:
+            yield run_file(mode, file, block_size, output_file, iv_name,
+                           True, split, use_mmap, pipeline, check, mirror,
+                           cache, report, journal)
+        return
+
+    def file_size(index):
+        try:
+            return os.path.getsize(tasks[index][0])
+        except OSError:
+            return 0
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [None] * len(tasks)
+        for index in sorted(range(len(tasks)), key=file_size, reverse=True):
+            file, output_file, iv_name, check = tasks[index]
+            futures[index] = pool.submit(run_file, mode, file, block_size,
+                                         output_file, iv_name, False, split,
+                                         use_mmap, pipeline, check, mirror,
+                                         cache, report, journal)
+        for future in futures:
+            yield future.result()
+
+
+TEST_RESULTS = {
+    0x01: ('plaintext', 'file is too small to be encrypted'),
+    0x02: ('plaintext', 'metadata signature was not found'),
+    0x04: ('damaged', 'unknown version of metadata'),
+    0x08: ('damaged', 'unsupported version of metadata'),
+    0x10: ('damaged', 'metadata integrity check failed'),
+    0x20: ('damaged', 'failed to read metadata from the file'),
+    0x40: ('damaged', 'the file could not be read'),
+}
+
+# the result of a file processed by FirmwareCrypto, the size is only known
+# for the test and the status is 'encrypted', 'plaintext' or 'damaged' for
+# the test, 'ok', 'failed' or 'skipped' otherwise
+FileResult = namedtuple('FileResult',
+                        ('file', 'output', 'size', 'code', 'status', 'reason'))
+
+
+def scan_files(files, jobs=1):
+    """Lazy function (generator) to test the files for the encryption with
+    scan_file(), yields (file, size, code) in the order of the files.
+
+    The reads are mostly waiting for the storage, so with more jobs many of
+    them are in flight at once on a thread pool."""
+    def scan(file):
+        try:
+            return scan_file(file)
+        except OSError as err:
+            print_v(f'{file}: {err.strerror or err}')
+            return None, 0x40
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        for file, (size, code) in zip(files, pool.map(scan, files)):
+            yield file, size, code
+
+
+def write_inventory(results, output_format, file_out=sys.stdout):
+    """Writes the FirmwareCrypto.test() results as a JSON or CSV inventory"""
+    fields = ('file', 'size', 'status', 'code', 'reason')
+    rows = ({field: getattr(result, field) for field in fields}
+            for result in results)
+    if output_format == 'json':
+        json.dump(list(rows), file_out, indent=2)
+        file_out.write('\n')
+    else:
+        writer = csv.DictWriter(file_out, fields, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+class FirmwareCrypto:
+    """An importable batch API: tests, encrypts and decrypts many files (or
+    whole firmware directories) in one process, so there is no interpreter
+    start per file.  The options are those of the command line (main() is a
+    thin wrapper over this class), the files are processed on a thread pool
+    with more jobs and the results are FileResult tuples in the order of
+    the files.  Verbose messages go to print_v (silent by default)."""
+
+    def __init__(self, block_size=None, jobs=1, split=1, use_mmap=False,
+                 pipeline=0, mirror=False, cache=None, report=None,
+                 journal=None):
+        self.block_size = block_size
+        self.jobs = jobs
+        self.split = split
+        self.use_mmap = use_mmap
+        self.pipeline = pipeline
+        self.mirror = mirror        # copy unencrypted files when decrypting
+        self.cache = cache          # an optional PlainCache
+        self.report = report        # an optional instrument.Report
+        self.journal = journal      # an optional Journal
+
+    @staticmethod
+    def expand(files):
+        """Returns the list of files with the directories walked"""
+        result = []
+        for file in files:
+            if os.path.isdir(file):
+                result += [os.path.join(path, name)
+                           for path, subdirs, names in os.walk(file)
+                           for name in names]
+            else:
+                result.append(file)
+        return result
+
+    def test(self, files):
+        """Tests the files (or directories) for the encryption"""
+        files = self.expand(files)
+        readable = [os.access(file, os.R_OK) for file in files]
+        scanned = scan_files([file for file, ok in zip(files, readable)
+                              if ok], self.jobs)
+        results = []
+        for file, ok in zip(files, readable):
+            if not ok:
+                results.append(FileResult(file, None, None, 0x40, 'skipped',
+                                          'does not exist or is not '
+                                          'readable'))
+                continue
+            file, size, code = next(scanned)
+            results.append(FileResult(
+                file, None, size, code,
+                TEST_RESULTS[code][0] if code else 'encrypted',
+                TEST_RESULTS[code][1] if code else ''))
+        return results
+
+    def encrypt(self, files, output=None):
+        """Encrypts the files (see output_name() for the output)"""
+        return list(self.results(perform_encrypt, files, output))
+
+    def decrypt(self, files, output=None, manifest=None):
+        """Decrypts the files, verifying them against the manifest (a
+        VersionManifest, see load_manifest()) if there is one"""
+        return list(self.results(perform_decrypt, files, output, manifest))
+
+    def results(self, mode, files, output=None, manifest=None):
+        """Lazy function (generator) to encrypt or decrypt the files, yields
+        the FileResult of every file as soon as it is known"""
+        # the skipped files are known up front, the processed ones are None
+        # until their codes come, so the results keep the order of the files
+        slots = []
+        tasks = []
+        for file in self.expand(files):
+            entry = None
+            if manifest:
+                if os.path.basename(file).startswith(
+                        os.path.basename(manifest.manifest)):
+                    # the manifest itself and similar files (see scan())
+                    slots.append(FileResult(file, None, None, 0, 'skipped',
+                                            'belongs to the manifest'))
+                    continue
+                entry = manifest.find(*os.path.split(os.path.relpath(
+                    os.path.abspath(file), manifest.firmware_dir)))
+            if not os.access(file, os.R_OK):
+                if entry is not None:   # fails the verification
+                    slots.append(FileResult(file, None, None, 0x80, 'failed',
+                                            'listed in the manifest but does '
+                                            'not exist or is not readable'))
+                else:
+                    slots.append(FileResult(file, None, None, 0x40, 'skipped',
+                                            'does not exist or is not '
+                                            'readable'))
+                continue
+            check = None
+            if manifest:
+                if entry is None:
+                    slots.append(FileResult(file, None, None, 0x80, 'failed',
+                                            'not listed in the manifest'))
+                    continue
+                check = (entry.size, entry.crc32)
+            output_file = output_name(file, output)
+            if output_file != '-' and os.path.exists(output_file) \
+                    and not (self.journal and self.journal.resume):
+                slots.append(FileResult(file, output_file, None, 0x40,
+                                        'failed', 'the output already exists'))
+                continue
+            # without an explicit output the IV is derived from the input name
+            tasks.append((file, output_file,
+                          None if output and output != '-' else file, check))
+            slots.append(None)
+
+        codes = zip(tasks, run_files(mode, tasks, self.block_size, self.jobs,
+                                     self.split, self.use_mmap, self.pipeline,
+                                     self.mirror, self.cache, self.report,
+                                     self.journal))
+        for result in slots:
+            if result is not None:
+                yield result
+                continue
+            (file, output_file, iv_name, check), code = next(codes)
+            if not code:
+                yield FileResult(file, output_file, None, 0, 'ok', '')
+            elif code == 0x80:
+                yield FileResult(file, output_file, None, code, 'failed',
+                                 'does not match the manifest')
+            elif code == 0x40:
+                yield FileResult(file, output_file, None, code, 'failed',
+                                 'the file could not be read or written')
+            else:
+                yield FileResult(file, output_file, None, code, 'failed',
+                                 TEST_RESULTS.get(code, ('', 'failed'))[1])
+
+def copy_file(source, target, written=None):
+    """Copies a file, optionally calculating the CRC32 and size of the copy
+    into the written dictionary (see process_file()) on the way"""
+    if written is None:
+        clone_file(source, target)
+        return
+    with open(source, 'rb') as file_in, open_output(target) as file_out:
+        file_out = CrcWriter(file_out)
+        for block in read_in_chunks(file_in, default_block_size(
+                os.fstat(file_in.fileno()).st_size)):
+            file_out.write(block)
+    written['crc32'] = file_out.crc32
+    written['size'] = file_out.size
+
+
+def same_content(file, other):
+    """Tells whether two files are the same (quick size and mtime check, the
+    contents are only compared if the sizes match but the times do not)"""
+    try:
+        stat, other_stat = os.stat(file), os.stat(other)
+    except FileNotFoundError:
+        return False
+    if stat.st_size != other_stat.st_size:
+        return False
+    if stat.st_mtime_ns == other_stat.st_mtime_ns:
+        return True
+    return filecmp.cmp(file, other, shallow=False)
+
+
+def repack_file(manifest, entry, source, baseline, output, block_size,
+                progress=True):
+    """Produces a single file of the repacked firmware (see repack()).
+
+    Returns the code and what has been done with the file: 'copied' (from the
+    original firmware), 'encrypted' or 'changed' (a plain file copied from
+    the source tree), 'added' (encrypted new file) or 'removed'."""
+    relative = os.path.join(entry.path, entry.name)
+    original = os.path.join(manifest.firmware_dir, relative)
+    modified = os.path.join(source, relative)
+    target = os.path.join(output, relative)
+    known = manifest.find(entry.path, entry.name) is entry
+
+    if known and not os.path.exists(modified):
+        if os.path.exists(os.path.join(baseline, relative)):
+            return 0, 'removed'     # deleted from the modified tree
+        modified = None             # never been decrypted, keep it as it is
+    elif known and same_content(modified, os.path.join(baseline, relative)):
+        modified = None
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if modified is None:
+        # the manifest entry of an unchanged file is still valid
+        copy_file(original, target)
+        return 0, 'copied'
+
+    written = {}
+    if known and isinstance(perform_test(original), int):
+        copy_file(modified, target, written)    # it was not encrypted
+        action = 'changed'
+    else:
+        code = process_file(perform_encrypt, modified, block_size, target,
+                            progress=progress, written=written)
+        if code:
+            return code, 'failed'
+        action = 'encrypted' if known else 'added'
+    entry.size = written['size']
+    entry.crc32 = written['crc32']
+    return 0, action
+
+
+def repack(manifest, source, baseline, output, block_size=None, jobs=1):
+    """Builds a new firmware from a modified plaintext tree in one pass.
+
+    The source and baseline trees mirror the firmware directory of the
+    manifest (the baseline being the unmodified plaintext), the result is
+    written into the output directory.  Unchanged files are copied from the
+    original firmware together with their manifest entries, changed and new
+    files are encrypted (or copied if the original was not encrypted) and
+    the CRC32 and size of each output are calculated while it is written,
+    so the new manifest is generated without reading the output again.
+    Returns the combined code of all the files."""
+    from vertu import VersionFile
+
+    entries = list(manifest.filelist)
+    for path, name, entry in manifest.scan(source):
+        if manifest.find(path, name) is None:
+            entries.append(VersionFile(f'{path}|{name}|14|0|0|1'))
+
+    def process(entry):
+        try:
+            return repack_file(manifest, entry, source, baseline, output,
+                               block_size, jobs <= 1)
+        except (OSError, EOFError) as err:
+            print_v(f'\r{entry.path}/{entry.name}: '
+                    f'{getattr(err, "strerror", None) or err}')
+            return 0x40, 'failed'
+
+    result = 0
+    filelist = []
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        for entry, (code, action) in zip(entries, pool.map(process, entries)):
+            print_v(f'{os.path.join(entry.path, entry.name)} => {action}')
+            result |= code
+            if action != 'removed':
+                filelist.append(entry)
+
+    manifest.filelist = filelist
+    manifest.reindex()
+    if not result:
+        manifest.generate(os.path.join(
+            output, manifest.manifest_dir, os.path.basename(manifest.manifest)))
+    return result
+
+
+def load_manifest(filename):
+    """Loads a firmware manifest using vertu.py (found next to this script)"""
+    from vertu import VersionManifest
+    return VersionManifest(filename)
 
 
 def main():
     global print_v
-    global args
 
     parser = argparse.ArgumentParser()
     mode = parser.add_mutually_exclusive_group()
@@ -208,23 +1415,128 @@ def main():
                         help='perform encryption')
     mode.add_argument('-d', '--decrypt', action='store_true',
                         help='perform decryption')
+    mode.add_argument('-R', '--repack', action='store_true',
+                        help='build a new firmware from a modified plaintext '
+                             'tree (requires -M, --baseline and -o)')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='enable verbose output')
     parser.add_argument('-b', '--block-size', type=int, dest='block_size',
-                        help='sets the read buffer in bytes (default 4096)',
-                        default=4*1024)
+                        help='sets the read buffer in bytes (default depends '
+                             'on the file size)')
     parser.add_argument('-o', '--output', type=str, dest='output',
-                        help="output directory where result will be stored")
-    parser.add_argument('file', type=str, nargs='+',
+                        help="output directory where result will be stored "
+                             "('-' writes a single file to the standard output)")
+    parser.add_argument('-j', '--jobs', type=int, dest='jobs', default=1,
+                        help='number of files to process in parallel '
+                             '(default 1, 0 means one per CPU)')
+    parser.add_argument('-m', '--mmap', action='store_true', dest='mmap',
+                        help='use memory mapped I/O for the files')
+    parser.add_argument('-p', '--pipeline', type=int, dest='pipeline',
+                        default=0, metavar='BUFFERS',
+                        help='overlap reading, crypto and writing using the '
+                             'given number of buffers (2 or 3, default off)')
+    parser.add_argument('-s', '--split', type=int, dest='split', default=1,
+                        help='number of ranges a large file is split into to '
+                             'be decrypted in parallel (default 1, 0 means '
+                             'one per CPU)')
+    parser.add_argument('-f', '--file-list', type=str, dest='file_list',
+                        help="read more input files from the given list, one "
+                             "per line ('-' reads the standard input)")
+    parser.add_argument('-M', '--manifest', type=str, dest='manifest',
+                        help='verify the size and CRC32 of the encrypted files '
+                             'against the manifest (a .ver file) while '
+                             'decrypting them, all the files listed in the '
+                             'manifest are used if no files are given')
+    parser.add_argument('--mirror', action='store_true', dest='mirror',
+                        help='copy the unencrypted files into the output as '
+                             'they are while decrypting, so a decrypted tree '
+                             'is complete')
+    parser.add_argument('-C', '--cache', type=str, dest='cache',
+                        help='a directory where the decrypted files are kept '
+                             'and reused when the same encrypted file is '
+                             'decrypted again')
+    parser.add_argument('--cache-limit', type=int, dest='cache_limit',
+                        default=0, metavar='MB',
+                        help='the size limit of the cache in MB, the least '
+                             'recently used files are evicted (default 0, no '
+                             'limit)')
+    parser.add_argument('--report', type=str, dest='report', metavar='FILE',
+                        help='write the timings of every file and of its '
+                             'stages into the file as JSON lines, followed '
+                             'by a summary')
+    parser.add_argument('--summary', action='store_true', dest='summary',
+                        help='print a summary of the timings and the '
+                             'throughput at the end')
+    parser.add_argument('--journal', type=str, dest='journal', metavar='FILE',
+                        help='record the completed files into the journal')
+    parser.add_argument('--resume', action='store_true', dest='resume',
+                        help='resume an interrupted run from its journal, '
+                             'skipping the files completed already')
+    parser.add_argument('--inventory', type=str, dest='inventory',
+                        choices=('json', 'csv'),
+                        help='print the results of the test as an inventory '
+                             'of encrypted, plaintext and damaged files')
+    parser.add_argument('--baseline', type=str, dest='baseline',
+                        help='the unmodified plaintext tree the files to '
+                             'repack are compared against')
+    parser.add_argument('file', type=str, nargs='*',
                         help="a list of input files for the selected operation")
     args = parser.parse_args()
 
+    manifest = None
+    if args.manifest:
+        if not args.decrypt and not args.repack:
+            parser.error('the manifest can only be used for decryption')
+        manifest = load_manifest(args.manifest)
+
+    if args.repack:
+        if not manifest or not args.baseline or not args.output \
+                or len(args.file) != 1:
+            parser.error('repacking requires -M, --baseline, -o and exactly '
+                         'one modified tree')
+        print_v = print if args.verbose else lambda *a, **k: None
+        import vertu    # loaded along with the manifest, keep it quiet too
+        vertu.print_v = print_v
+        result = repack(manifest, args.file[0], args.baseline, args.output,
+                        args.block_size,
+                        args.jobs if args.jobs > 0 else os.cpu_count() or 1)
+        if result:
+            print('ERROR: repacking has failed (use -v to see the details)')
+        sys.exit(result)
+
+    if args.file_list:
+        with (nullcontext(sys.stdin) if args.file_list == '-'
+              else open(args.file_list)) as list_in:
+            args.file += [line.rstrip('\r\n') for line in list_in
+                          if line.strip()]
+    if not args.file and manifest and not args.file_list:
+        args.file = [os.path.join(manifest.firmware_dir, file.path, file.name)
+                     for file in manifest.filelist]
+    if not args.file:
+        if args.file_list:  # e.g. nothing has changed between two releases
+            sys.exit(0)
+        parser.error('at least one input file is required')
+
     print_v = print if args.verbose else lambda *a, **k: None
 
-    if args.block_size % 16:
+    if args.block_size is not None and (
+            args.block_size <= 0 or args.block_size % 16):
         print('ERROR: the specified block size is not aligned, should be dividable by 16!')
         sys.exit(1)
 
+    if args.mirror and not args.decrypt:
+        parser.error('mirroring can only be used for decryption')
+
+    if args.cache and not args.decrypt:
+        parser.error('the cache can only be used for decryption')
+
+    if args.inventory and not args.test:
+        parser.error('the inventory can only be created by the test')
+
+    if args.output == '-' or args.inventory:
+        # the data goes to the standard output, so all messages go to stderr
+        sys.stdout = sys.stderr
+
     if args.output:
         if args.output[-1] == "/":
             print_v('output set to a directory')
@@ -250,32 +1562,74 @@ def main():
         print_v('a decryption')
         mode = perform_decrypt
 
+    if args.resume and not args.journal:
+        parser.error('resuming requires the journal of the run')
+
+    journal = None
+    if args.journal and not args.test:
+        journal = Journal(args.journal, args.resume)
+
+    report = None
+    if args.report or args.summary:
+        report = Report(args.report)
+
+    cache = None
+    if args.cache:
+        cache = PlainCache(args.cache, args.cache_limit * 1024 * 1024)
+
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count() or 1
+    split = args.split if args.split > 0 else os.cpu_count() or 1
+
+    crypto = FirmwareCrypto(args.block_size, jobs, split, args.mmap,
+                            args.pipeline, args.mirror, cache, report, journal)
+    # only the first directory is processed, as it always has been
+    files = args.file[:1] if os.path.isdir(args.file[0]) else args.file
+
     result = 0
-    files_to_process = [os.path.join(path, name) for path, subdirs, files in os.walk(args.file[0]) for name in files] if os.path.isdir(args.file[0]) else args.file 
-    for file in files_to_process:
-        if not os.access(file, os.R_OK):
-            print_v(f'{file} does not exist or is not readable, skipping')
-            continue
-        if args.test:
-            file_result = perform_test(file)
-            if isinstance(file_result, int) and file_result != 0:
-                result |= file_result
-                print_v(f'{file} => not encrypted or invalid')
+    if args.test:
+        results = crypto.test(files)
+        if args.inventory:
+            write_inventory([file_result for file_result in results
+                             if file_result.status != 'skipped'],
+                            args.inventory, sys.__stdout__)
+        for file_result in results:
+            if file_result.status == 'skipped':
+                print_v(f'{file_result.file} {file_result.reason}, skipping')
+                continue
+            result |= file_result.code
+            if file_result.code:
+                print_v(f'{file_result.file} => not encrypted or invalid')
             else:
-                print_v(f'{file} => encrypted')
+                print_v(f'{file_result.file} => encrypted')
+        sys.exit(result)
+
+    for file_result in crypto.results(mode, files, args.output, manifest):
+        if file_result.status == 'skipped':
+            print_v(f'{file_result.file} {file_result.reason}, skipping')
+            continue
+        result |= file_result.code
+        if file_result.code in TEST_RESULTS and file_result.code != 0x40:
+            print(f'{file_result.file} is either unencrypted or damaged (use -v -t to see the details)')
+        elif file_result.code:
+            print(f'{file_result.file}: {file_result.reason}')
         else:
-            output_file = args.output
-            if args.output:
-                if args.output[-1] == "/":
-                    output_file = os.path.join(args.output, os.path.relpath(file))
-                    print(f'{output_file}')
-                    if not os.path.isdir(os.path.dirname(output_file)):
-                        print_v(f'creating output directory "{args.output}"')
-                        os.makedirs(os.path.dirname(output_file))
-            else:
-                output_file = f'{file}.out'
-            process_file(mode, file, args.block_size, output_file)
-            print_v(f'{file} => {output_file}')
+            if mode == perform_encrypt and (not args.output
+                                            or args.output == '-'):
+                print(f"Warning: because no specific output name was specified, the file was encrypted using the input file name ({os.path.basename(file_result.file)}), since it is assumed you will have to rename it from the final .out.")
+            if args.output and args.output[-1] == "/":
+                print(f'{file_result.output}')
+            print_v(f'{file_result.file} => {file_result.output}')
+
+    if cache:
+        cache.trim()
+
+    if journal:
+        journal.close()
+
+    if report:
+        report.close()
+        if args.summary:
+            print(report.table())
 
     sys.exit(result)
 